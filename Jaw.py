@@ -1,42 +1,112 @@
 from annotation.utils.image import get_mask_by_label
+from annotation.utils.VolumeStatistics import VolumeStatistics
 from conf import labels as l
-from dicom_loader import dicom_from_dicomdir
+from dicom_loader import load_slices, pack_overlays, read_dicom_headers, read_overlays, series_from_dicomdir, \
+    LOADER_WORKERS
 import numpy as np
+import pydicom
 from pydicom.filereader import read_dicomdir
-from pydicom.pixel_data_handlers.numpy_handler import pack_bits
 import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from Plane import Plane
+from Plane import Plane, PlaneStack
 import processing
+import resampling
+from resampling import ResamplingPlan, RESAMPLING_WORKERS
+from volume_cache import VolumeCache
 
 OVERLAY_ADDR = 0x6004
+LABEL_OVERLAY_ADDRS = {l.CONTOUR: 0x6006, l.INSIDE: 0x6008, l.BG: 0x600A, l.UNLABELED: 0x600C}
+LABEL_OVERLAY_DESCS = {l.CONTOUR: "Contour", l.INSIDE: "Inside", l.BG: "Background", l.UNLABELED: "Unlabeled"}
+PIXEL_DATA_TAG = (0x7FE0, 0x0010)
 MIN_QUANTILE = 0.02
 MAX_QUANTILE = 0.98
+CACHE_VERSION = 3  # increase it whenever the volumes computed by Jaw.__init__ change
+CACHED_VOLUMES = ['volume', 'final_HU', 'gt_volume', 'HU_volume']
+LOW_MEMORY_CACHED_VOLUMES = ['volume', 'HU', 'gt_volume']
+CHUNK_SLICES = 32  # amount of slices processed at once by the low memory pipeline
+PYRAMID_LEVELS = 3  # previews of the volume downsampled by 2, 4 and 8
+# resampling methods of the interpolation functions, for line_slice and plane_slice
+LINE_INTERPOLATIONS = {'bilinear_interpolation': 'bilinear', 'bicubic_interpolation': 'bicubic'}
+PLANE_INTERPOLATIONS = {'trilinear_interpolation': 'trilinear', 'bicubic_interpolation_3d': 'tricubic'}
+PLAN_CACHE_SIZE = 8  # resampling plans kept in memory, the least recently used ones are dropped
 
 
 class Jaw:
-
-    def __init__(self, dicomdir_path):
+    HU = None  # HU volume stored as int16 (float32 if needed), available in low memory mode only
+    gt_labels = None  # label volume read from the per-label overlays, decoded by get_gt_labels on first request
+    _final_HU = None
+    _HU_volume = None
+
+    def __init__(self, dicomdir_path, step_fn=None, loader_workers=LOADER_WORKERS, loader_executor='thread',
+                 keep_pixel_data=True, use_cache=True, low_memory=False, z_contiguous=False,
+                 resampling_workers=RESAMPLING_WORKERS):
         """
         initialize a jaw object from a dicomdir path
         Args:
             dicomdir_path (String): path to the dicomdir file, MUST include the final DICOMDIR,
-            flip (Bool): initial flip of the volume and dicom file lists?
+            step_fn: function to log the progress of the slices loading
+            loader_workers (Int): amount of workers used to read and decode the DICOM slices
+            loader_executor (String): kind of pool used by the loader, 'thread' or 'process'
+            keep_pixel_data (Bool): if false only the headers of the DICOM files are retained, their raw PixelData
+                is released after decoding and streamed back from disk when the files are saved
+            use_cache (Bool): read the derived volumes from the on-disk cache next to the DICOMDIR if they are
+                available, store them there otherwise
+            low_memory (Bool): memory budget mode. the volume is normalized in place as float32, HU values are
+                stored as int16 and final_HU / HU_volume are derived on first request, memory-mapped from the
+                on-disk cache when there is one
+            z_contiguous (Bool): keep a (H, W, Z) copy of the volume where each Z column is contiguous, read by the
+                interpolations that gather whole columns (line_slice, create_panorex, bilinear_interpolation).
+                faster cuts for twice the memory of the volume
+            resampling_workers (Int): amount of threads computing many cuts at once, 1 computes them sequentially.
+                the cuts are identical whatever the amount of threads
         """
         basename = os.path.basename(dicomdir_path)
         if basename.lower() != 'dicomdir':
             raise Exception("ERROR: DICOMDIR PATH HAS TO END WITH DICOMDIR")
 
         self.dicom_dir = read_dicomdir(os.path.join(dicomdir_path))
-        self.filenames, self.dicom_files, self.volume = dicom_from_dicomdir(self.dicom_dir)
+        self.filenames, paths = series_from_dicomdir(self.dicom_dir)
+        self.keep_pixel_data = keep_pixel_data
+        self.low_memory = low_memory
+        self.modified_slices = set()  # slices whose overlays differ from the original DICOM files
+        self.dirty_slices = set()  # slices whose overlays changed since the last export
+        self.export_path = None  # directory of the last export
+
+        version = "{}{}".format(CACHE_VERSION, "-low_memory" if low_memory else "")
+        cache = VolumeCache(dicomdir_path, paths, version) if use_cache else None
+        self.cache = cache
+        self.pyramid = {}  # downsampled volumes, by level
+        self.plans = OrderedDict()  # resampling plans, by key of their geometry
+        self.plans_lock = threading.Lock()  # cuts computed on many threads share the plans
+        self.z_contiguous = z_contiguous
+        self.resampling_workers = resampling_workers
+        self.z_roi = None  # Z region of interest of the cuts, see set_z_roi
+        self.columns = None  # (H, W, Z) copy of the volume, see get_column_volume
+        if cache is not None and cache.exists():
+            # derived volumes are memory-mapped, headers are enough for the DICOM files
+            self.keep_pixel_data = False
+            self.dicom_files = read_dicom_headers(paths, workers=loader_workers, step_fn=step_fn)
+            self.__load_cache(cache)
+            return
+
+        self.dicom_files, self.volume = load_slices(paths, workers=loader_workers, executor=loader_executor,
+                                                    keep_pixel_data=keep_pixel_data, step_fn=step_fn)
         self.Z, self.H, self.W = self.volume.shape
         self.HU_intercept, self.HU_slope = self.__get_HU_rescale_params()
+        # one histogram of the raw data answers quantiles, min/max and window presets
+        self.stats = VolumeStatistics(self.volume, self.HU_slope, self.HU_intercept)
+
+        if low_memory:
+            self.__build_low_memory_volumes()
+            cache is not None and self.__save_cache(cache)
+            return
 
         # ADJUST WINDOW
-        w = self.dicom_files[0].WindowWidth
-        c = self.dicom_files[0].WindowCenter
-        ymax = c + (w / 2)
-        ymin = c - (w / 2)
+        c, w, ymin, ymax = self.__get_window_params()
 
         tmp = self.volume * self.HU_slope + self.HU_intercept
         # windowing - no matter how you change data in tool, final_HU is the best input range and will be used when dumping volumes.npy
@@ -44,10 +114,9 @@ class Jaw:
         self.final_HU = ((self.final_HU - (c - .5)) / (w - 1) + .5) * (ymax - ymin) + ymin
         self.final_HU[tmp < (c - .5 - (w - 1) / 2)] = ymin
         self.final_HU[tmp > (c - .5 + (w - 1) / 2)] = ymax
-        print(self.final_HU.min(), print(self.final_HU.max()))
         # END ADJUST WINDOW
 
-        if self.dicom_files[1].ImagePositionPatient[-1] - self.dicom_files[0].ImagePositionPatient[-1] > 0:  # Z-axis has to be flipped
+        if self.__is_z_flipped():  # Z-axis has to be flipped
             self.volume = np.flip(self.volume, 0)
             self.final_HU = np.flip(self.final_HU, 0)
             self.dicom_files.reverse()
@@ -58,6 +127,43 @@ class Jaw:
         self.__normalize()
         self.gt_volume = self.__build_ann_volume()
         self.HU_volume = self.convert_01_to_HU(self.volume)
+        cache is not None and self.__save_cache(cache)
+
+    @property
+    def final_HU(self):
+        """HU volume windowed with the DICOM window, computed on first request in low memory mode"""
+        if self._final_HU is None and self.HU is not None:
+            self._final_HU = self.__get_derived_volume('final_HU', self.__window_HU)
+        return self._final_HU
+
+    @final_HU.setter
+    def final_HU(self, final_HU):
+        self._final_HU = final_HU
+
+    @property
+    def HU_volume(self):
+        """HU values of the normalized volume, computed on first request in low memory mode"""
+        if self._HU_volume is None and self.HU is not None:
+            self._HU_volume = self.__get_derived_volume('HU_volume', self.__rescale_HU)
+        return self._HU_volume
+
+    @HU_volume.setter
+    def HU_volume(self, HU_volume):
+        self._HU_volume = HU_volume
+
+    def memory_report(self):
+        """
+        bytes held by each array attribute of the jaw and by the pixel data retained in the DICOM files.
+        memory-mapped arrays are reported with their full size even if they are not resident.
+
+        Returns:
+            (dict): attribute name -> bytes
+        """
+        report = {
+            name.lstrip('_'): value.nbytes for name, value in vars(self).items() if isinstance(value, np.ndarray)
+        }
+        report['dicom_files'] = sum(len(dicom.PixelData) for dicom in self.dicom_files if PIXEL_DATA_TAG in dicom)
+        return report
 
     def merge_predictions(self, plane, pred):
         """
@@ -112,23 +218,26 @@ class Jaw:
         ds.add_new((overlay_addr, 0x0102), "US", 0)
         ds.add_new((overlay_addr, 0x3000), "OB", overlay_data)
 
-    def __overwrite_address(self, volume, overlay_addr=OVERLAY_ADDR, overlay_desc="Marker"):
+    def __overwrite_address(self, packed, overlay_addr=OVERLAY_ADDR, overlay_desc="Marker"):
         """
         Overwrites a specific overlay address with given volumetric data.
 
         Args:
-            volume (np.ndarray): volumetric data
+            packed (np.ndarray): (Z, bytes) overlay data of each slice, as returned by pack_overlays
             overlay_addr (int): address
+            overlay_desc (str): description
         """
         for slice_num in range(len(self.dicom_files)):
-            overlay = volume[slice_num].flatten()
-            packed_bytes = pack_bits(overlay)
-            if len(packed_bytes) % 2:  # padding if needed
-                packed_bytes += b'\x00'
-            if self.dicom_files[slice_num].get((overlay_addr, 0x3000)) is None:
+            packed_bytes = packed[slice_num].tobytes()
+            overlay = self.dicom_files[slice_num].get((overlay_addr, 0x3000))
+            if overlay is None:
                 self.__add_overlay(self.dicom_files[slice_num], packed_bytes, overlay_addr, overlay_desc)
+            elif overlay.value != packed_bytes:
+                overlay.value = packed_bytes
             else:
-                self.dicom_files[slice_num][overlay_addr, 0x3000].value = packed_bytes
+                continue
+            self.modified_slices.add(slice_num)
+            self.dirty_slices.add(slice_num)
 
     def overwrite_annotations(self):
 
@@ -139,29 +248,117 @@ class Jaw:
         if len(self.dicom_files) != self.gt_volume.shape[0]:
             raise Exception("ground truth volume has invalid shape with respect to the DICOM files!")
 
-        volume = self.get_gt_volume(labels=[l.CONTOUR, l.INSIDE])
-        contour = get_mask_by_label(self.gt_volume, l.CONTOUR)
-        inside = get_mask_by_label(self.gt_volume, l.INSIDE)
-        bg = get_mask_by_label(self.gt_volume, l.BG)
-        unlabeled = get_mask_by_label(self.gt_volume, l.UNLABELED)
+        labels = list(LABEL_OVERLAY_ADDRS.keys())
+        lut = self.__overlay_planes_lut(labels, binary=np.max(self.gt_volume) in [0, 1])
+        num_bytes = (self.H * self.W + 7) // 8
+        packed = np.empty((len(labels) + 1, self.Z, num_bytes + num_bytes % 2), np.uint8)
+        for z in range(0, self.Z, CHUNK_SLICES):
+            # every bitplane of the chunk in a single lookup
+            gt = self.gt_volume[z:z + CHUNK_SLICES].astype(np.intp)
+            packed[:, z:z + CHUNK_SLICES] = pack_overlays(lut.take(gt, axis=0, mode='clip'))
+
+        self.__overwrite_address(packed[0], OVERLAY_ADDR)
+        for plane, label in enumerate(labels, 1):
+            self.__overwrite_address(packed[plane], LABEL_OVERLAY_ADDRS[label], LABEL_OVERLAY_DESCS[label])
+
+    @staticmethod
+    def __overlay_planes_lut(labels, binary):
+        """
+        lookup table from the values of gt_volume to its overlay bitplanes: the binary CONTOUR | INSIDE annotation
+        followed by one plane per label
 
-        self.__overwrite_address(volume, OVERLAY_ADDR)
-        self.__overwrite_address(contour, 0x6006, "Contour")
-        self.__overwrite_address(inside, 0x6008, "Inside")
-        self.__overwrite_address(bg, 0x600A, "Background")
-        self.__overwrite_address(unlabeled, 0x600C, "Unlabeled")
+        Args:
+            labels (list of int): labels with a plane
+            binary (bool): gt_volume only holds 0-1 values, which are the binary annotation already
 
-    def save_dicom(self, path):
+        Returns:
+            (np.ndarray): (256, len(labels) + 1) bool table
         """
-        export the dicom files and the dicomdir to the path folder
+        values = np.arange(256)
+        lut = np.stack([values == label for label in labels], axis=1)
+        annotated = values == 1 if binary else (values == l.CONTOUR) | (values == l.INSIDE)
+        return np.concatenate([annotated[:, np.newaxis], lut], axis=1)
+
+    def save_dicom(self, path, workers=LOADER_WORKERS):
+        """
+        export the dicom files and the dicomdir to the path folder.
+        the export is incremental: exporting again to the same folder only rewrites the slices whose overlays
+        changed in the meantime, while in a new folder the slices never modified are hard-linked (or copied)
+        from the original files. files are written concurrently.
 
         Args:
             path (str): path where dicom files are going to be saved
+            workers (int): amount of threads writing the files
         """
+        path = os.path.abspath(path)
         Path(path).mkdir(parents=True, exist_ok=True)
-        self.dicom_dir.save_as(os.path.join(path, 'DICOMDIR'))
+        same_path = path == self.export_path
+        dicomdir_filename = os.path.join(path, 'DICOMDIR')
+        if not same_path or not os.path.isfile(dicomdir_filename):
+            self.dicom_dir.save_as(dicomdir_filename)
+
+        jobs = []
         for i, dicom in enumerate(self.dicom_files):
-            dicom.save_as(os.path.join(path, self.filenames[i]))
+            filename = os.path.join(path, self.filenames[i])
+            if same_path and i not in self.dirty_slices and os.path.isfile(filename):
+                continue  # already exported
+            if i in self.modified_slices or i in self.dirty_slices:
+                jobs.append((self.__save_dicom_file, dicom, filename))
+            elif not os.path.isfile(filename) or not os.path.samefile(dicom.filename, filename):
+                jobs.append((self.__link_dicom_file, dicom.filename, filename))
+
+        with ThreadPoolExecutor(max_workers=max(1, workers or 1)) as pool:
+            for future in [pool.submit(*job) for job in jobs]:
+                future.result()
+        self.export_path = path
+        self.dirty_slices.clear()
+
+    def __save_dicom_file(self, dicom, filename):
+        """
+        save a single dicom file. if only its header is retained, the pixel data is read back from
+        the original file just for the time of the writing
+
+        Args:
+            dicom (pydicom.dataset.FileDataset): dataset to save
+            filename (str): destination path
+        """
+        if PIXEL_DATA_TAG in dicom:
+            self.__unlink(filename)
+            dicom.save_as(filename)
+            return
+        source = pydicom.dcmread(dicom.filename, specific_tags=[PIXEL_DATA_TAG])
+        dicom[PIXEL_DATA_TAG] = source[PIXEL_DATA_TAG]
+        try:
+            self.__unlink(filename)
+            dicom.save_as(filename)
+        finally:
+            del dicom[PIXEL_DATA_TAG]
+
+    def __link_dicom_file(self, source, filename):
+        """
+        export an unmodified dicom file as a hard link of the original one, or as a copy
+        if the file system does not support it
+
+        Args:
+            source (str): path of the original file
+            filename (str): destination path
+        """
+        self.__unlink(filename)
+        try:
+            os.link(source, filename)
+        except OSError:
+            shutil.copyfile(source, filename)
+
+    @staticmethod
+    def __unlink(filename):
+        """
+        remove an exported file before writing it again, a hard link to an original file is never written through
+
+        Args:
+            filename (str): path of the file
+        """
+        if os.path.lexists(filename):
+            os.remove(filename)
 
     ###############
     # CUT FUNCTIONS
@@ -198,7 +395,8 @@ class Jaw:
         else:
             return np.squeeze(self.volume[:, y_val, :])
 
-    def line_slice(self, xy_set, cut_gt=False, interp_fn='bilinear_interpolation', step_fn=None):
+    def line_slice(self, xy_set, cut_gt=False, interp_fn='bilinear_interpolation', step_fn=None, cancel_event=None,
+                   z_range=None, cache_plan=True):
         """
         make a slice using a set of xy coordinates.
         if cut_gt is true the cut is performed on the annotated binary volume and the nearest neighbour interpolation
@@ -209,70 +407,73 @@ class Jaw:
         Args:
             xy_set (2D or 3D numpy array):
             cut_gt (bool): if true cuts the ground truth image, if false cuts the original volume.
-                Possible values are: bilinear_interpolation, bicubic_interpolation
             interp_fn (str): name of the interpolation function
+                Possible values are: bilinear_interpolation, bicubic_interpolation
+            step_fn: function to log progress
+            cancel_event (threading.Event): once set the cuts left are skipped and None is returned
+            z_range ((int, int)): first and last (excluded) slice of the cuts, the Z region of interest if None
+            cache_plan (bool): keeps the resampling plan in the cache of the plans, one-off cuts should not evict
+                the plans that are used again
 
         Returns:
-            a 2D or 3D numpy array with the cuts
+            a 2D or 3D numpy array with the cuts, None if they were canceled
         """
 
-        if cut_gt:
-            interp_fn = lambda x, y: self.gt_volume[:, int(y), int(x)]  # nearest
-        else:
-            interp_fn = getattr(self, interp_fn)
-
         if len(xy_set.shape) == 2:  # one xy set or many?
             xy_set = xy_set[np.newaxis]
 
-        h = self.Z  # depth of the volume
-        w = max([len(points) for points in xy_set])
-        num_cuts = xy_set.shape[0]
-
-        cut = np.zeros((num_cuts, h, w), np.float32)  # result image
-        for num_cut in range(num_cuts):
-            step_fn is not None and step_fn(num_cut, num_cuts)
-            for w_id, (x, y) in enumerate(xy_set[num_cut]):
-                if (x - 2) < 0 or (y - 2) < 0 or (x + 2) >= self.W or (y + 2) >= self.H:
-                    cut[num_cut, :, w_id] = np.zeros(shape=self.Z)  # fill the array with zeros if overflowing
-                else:
-                    cut[num_cut, :, w_id] = interp_fn(x, y)  # interpolation
-
-        # fixing possible overflows
-        cut[cut > 1] = 1
-        cut[cut < 0] = 0
+        # all the cuts are resampled at once, points too close to the border are filled with zeros.
+        # plans are cached, the same side_coords are resampled again on both volumes
+        kwargs = {'step_fn': step_fn, 'workers': self.resampling_workers, 'cancel_event': cancel_event,
+                  'z_range': self.get_z_range() if z_range is None else z_range}
+        method = 'nearest' if cut_gt else LINE_INTERPOLATIONS.get(interp_fn, interp_fn)
+        if cache_plan:
+            plan = self.get_resampling_plan('lines', xy_set, method)
+        else:
+            plan = ResamplingPlan.build('lines', np.asarray(xy_set, np.float64), self.volume.shape, method)
+        if cut_gt:
+            cut = plan.apply(self.gt_volume, **kwargs)
+        else:
+            cut = plan.apply(self.volume, columns=self.get_column_volume(), **kwargs)
+        if cut is None:
+            return None
 
+        np.clip(cut, 0, 1, out=cut)  # fixing possible overflows
         return np.squeeze(cut)  # clean axis 0 in case of just one cut
 
-    def plane_slice(self, plane, cut_gt=False, interp_fn='trilinear_interpolation'):
+    def plane_slice(self, plane, cut_gt=False, interp_fn='trilinear_interpolation', z_range=None):
         """
         cut the volumes according to a plane of coordinates. the resulting image has the shape of the plane.
         each point of the plane contains the set of zxy coordinates where the function perform the interpolation.
 
         Args:
             plane (3D numpy array): shape is 3xZxW where W is the len of the xy set of coordinates.
-                values are ordered as follow: [0] z coords, [1] x coords, [2] y coords
+                values are ordered as follow: [0] x coords, [1] y coords, [2] z coords.
+                a Nx3xZxW stack of planes or a PlaneStack can be passed as well
             cut_gt (bool): if true cuts is performed on the ground truth volume
             interp_fn (string): name of the interpolation function, if cut_gt is True the interp_fn is nearest.
+                Possible values are: trilinear_interpolation, bicubic_interpolation_3d
+            z_range ((int, int)): first and last (excluded) row of the plane to cut, the Z region of interest if None
 
         Returns:
-            cut (2D numpy array)
+            cut (2D numpy array, 3D for a stack of planes)
         """
 
-        if type(plane) is Plane:  # get numpy array if plane obj is passed
-            plane = plane.get_plane()
-
-        if cut_gt:
-            interp_fn = lambda z, x, y: self.gt_volume[int(z), int(y), int(x)]  # nearest
-        else:
-            interp_fn = getattr(self, interp_fn)
-
-        cut = np.zeros((self.Z, plane.shape[2]))
-        for row in range(self.Z):
-            for col in range(plane.shape[2]):
-                cut[row, col] = interp_fn(plane[2, row, col], plane[0, row, col], plane[1, row, col])  # z, x, y
-        return cut
-
-    def create_panorex(self, coords, include_annotations=False):
+        if type(plane) is Plane:  # get numpy array if plane obj is passed, it is only read
+            plane = plane.plane
+        elif type(plane) is PlaneStack:
+            plane = plane.get_planes()
+
+        # the whole plane is resampled at once, the plans of single planes are cached
+        z0, z1 = self.get_z_range() if z_range is None else z_range
+        plane = plane[..., :self.Z, :][..., z0:z1, :]
+        volume = self.gt_volume if cut_gt else self.volume
+        method = 'nearest' if cut_gt else PLANE_INTERPOLATIONS.get(interp_fn, interp_fn)
+        if plane.ndim > 3:
+            return resampling.plane_slice(volume, plane, method=method, workers=self.resampling_workers)
+        return self.get_resampling_plan('planes', plane, method).apply(volume)
+
+    def create_panorex(self, coords, include_annotations=False, z_range=None):
         """
         Create a 2D panorex image from a set of coordinates on the dental arch
 
@@ -280,37 +481,138 @@ class Jaw:
             coords (float numpy array): set of coordinates for the cut
             include_annotations (bool): if this flag is set, the panorex image is returned as an RGB
             image where the labels are marked in red
+            z_range ((int, int)): first and last (excluded) slice to cut, the whole volume if None.
+                the panorex keeps all the slices, the ones out of the range are left black, so that
+                the canal splines drawn on it keep their coordinates
 
         Returns:
             panorex (numpy array)
         """
-        panorex = np.zeros((self.Z, len(coords)), np.float32)
-        for idx, (x, y) in enumerate(coords):
-            try:
-                panorex[:, idx] = self.bilinear_interpolation(x, y)
-            except:
-                continue
+        # columns out of the volume are left black
+        z0, z1 = (0, self.Z) if z_range is None else z_range
+        plan = self.get_resampling_plan('coords', coords, 'bilinear')
+        panorex = np.zeros((self.Z, plan.get_shape()[-1]), np.float32)
+        plan.apply(self.volume, out=panorex[np.newaxis, z0:z1], columns=self.get_column_volume(), z_range=(z0, z1))
 
         if include_annotations:
-            panorex_gt = np.zeros((self.Z, len(coords)), np.float32)
-            for idx, (x, y) in enumerate(coords):
-                try:
-                    panorex_gt[:, idx] = np.max(
-                        self.gt_volume[
-                        :,
-                        int(np.floor(y)):int(np.floor(y) + 1) + 1,
-                        int(np.floor(x)):int(np.floor(x) + 1) + 1
-                        ],
-                        axis=(1, 2)
-                    )
-                except:
-                    continue
+            # max label of the 2x2 pixels at the bottom right of each point, as the slices [floor:floor + 2]
+            # of python would pick them. points out of the volume have no labels
+            x, y = np.floor(np.asarray(coords, np.float64).reshape(-1, 2)).astype(np.intp).T
+            (x1, x2, x_valid), (y1, y2, y_valid) = self.__slice_bounds(x, self.W), self.__slice_bounds(y, self.H)
+            valid = x_valid & y_valid
+            labels = [self.gt_volume[z0:z1, y_, x_] for y_ in (y1, y2) for x_ in (x1, x2)]
+            panorex_gt = np.zeros(panorex.shape, self.gt_volume.dtype)
+            panorex_gt[z0:z1] = np.max(labels, axis=0) * valid
             panorex = processing.grey_to_rgb(panorex)
             idx = np.argwhere(panorex_gt)
             panorex[idx[:, 0], idx[:, 1]] = (1, 0, 0)
 
         return panorex
 
+    def create_panorexes(self, arches, include_annotations=False, z_range=None):
+        """
+        Create the panorexes of several arches at once: the points of all the arches are resampled, and their
+        annotations looked up, in a single vectorized pass of create_panorex
+
+        Args:
+            arches (list of float numpy array): sets of coordinates of the arches
+            include_annotations (bool): panorexes are RGB images with the labels marked in red
+            z_range ((int, int)): first and last (excluded) slice to cut, see create_panorex
+
+        Returns:
+            (list of numpy array): panorex of each arch
+        """
+        if len(arches) == 0:
+            return []
+        coords = [np.asarray(arch, np.float64).reshape(-1, 2) for arch in arches]
+        panorex = self.create_panorex(np.concatenate(coords), include_annotations, z_range)
+        splits = np.cumsum([len(arch) for arch in coords])[:-1]
+        return [np.ascontiguousarray(p) for p in np.split(panorex, splits, axis=1)]
+
+    def set_z_roi(self, z_range=None):
+        """
+        set the Z region of interest of the cuts: line_slice and plane_slice only cut the slices of the range,
+        the panorex is always cut on the whole volume. the range is clipped on the volume.
+
+        Args:
+            z_range ((int, int)): first and last (excluded) slice, None for the whole volume
+        """
+        if z_range is None:
+            self.z_roi = None
+            return
+        z0, z1 = max(0, int(z_range[0])), min(self.Z, int(z_range[1]))
+        if z0 >= z1:
+            raise ValueError("empty Z region of interest {}".format(z_range))
+        self.z_roi = None if (z0, z1) == (0, self.Z) else (z0, z1)
+
+    def get_z_range(self):
+        """
+        Returns:
+            (int, int): first and last (excluded) slice cut by default, the Z region of interest or the whole volume
+        """
+        return self.z_roi if self.z_roi is not None else (0, self.Z)
+
+    def get_resampling_plan(self, geometry, coords, method):
+        """
+        resampling plan of a set of coordinates, built once and kept in a small LRU cache.
+        the same plan can be applied to volume and gt_volume.
+
+        Args:
+            geometry (str): 'lines' for side_coords, 'coords' for arch coordinates or 'planes' for planes
+            coords (numpy array): coordinates of the points
+            method (str): resampling method, see resampling.ResamplingPlan
+
+        Returns:
+            (resampling.ResamplingPlan): the plan
+        """
+        coords = np.asarray(coords, np.float64)
+        key = ResamplingPlan.compute_key(geometry, coords, self.volume.shape, method)
+        with self.plans_lock:
+            plan = self.plans.get(key)
+            if plan is not None:
+                self.plans.move_to_end(key)
+                return plan
+        plan = ResamplingPlan.build(geometry, coords, self.volume.shape, method)
+        self.__add_resampling_plan(key, plan)
+        return plan
+
+    def save_resampling_plan(self, path, geometry, coords, method):
+        """
+        store the resampling plan of a set of coordinates, along with the key of their geometry
+
+        Args:
+            path (str): path of the npz file
+            geometry (str): 'lines', 'coords' or 'planes'
+            coords (numpy array): coordinates of the points
+            method (str): resampling method
+        """
+        key = ResamplingPlan.compute_key(geometry, coords, self.volume.shape, method)
+        self.get_resampling_plan(geometry, coords, method).save(path, key)
+
+    def load_resampling_plan(self, path, geometry, coords, method):
+        """
+        load a resampling plan stored with save_resampling_plan into the cache of the plans,
+        if it was built from the same coordinates
+
+        Args:
+            path (str): path of the npz file
+            geometry (str): 'lines', 'coords' or 'planes'
+            coords (numpy array): coordinates of the points
+            method (str): resampling method
+
+        Returns:
+            (bool): the plan has been loaded
+        """
+        if not os.path.isfile(path):
+            return False
+        key = ResamplingPlan.compute_key(geometry, coords, self.volume.shape, method)
+        plan, stored_key = ResamplingPlan.load(path)
+        if stored_key != key:
+            print("WARNING: resampling plan {} does not match the current coordinates".format(path))
+            return False
+        self.__add_resampling_plan(key, plan)
+        return True
+
     def convert_01_to_HU(self, data):
         return data * self.max_value * self.HU_slope + self.HU_intercept
 
@@ -344,15 +646,142 @@ class Jaw:
             gt += get_mask_by_label(self.gt_volume, label)
         return gt
 
+    def get_gt_labels(self):
+        """
+        label volume saved by overwrite_annotations, decoded from the DICOM files on first request
+        and stored in the on-disk cache.
+
+        Returns:
+            (numpy array): uint8 label volume, None if the files don't have it
+        """
+        if self.gt_labels is None:
+            gt_labels = self.cache.load_array('gt_labels') if self.cache is not None else None
+            if gt_labels is None:
+                gt_labels = self.__build_labels_volume()
+                gt_labels is not None and self.cache is not None and self.__save_cache_array('gt_labels', gt_labels)
+            self.gt_labels = gt_labels
+        return self.gt_labels
+
     def get_HU_volume(self):
         return self.HU_volume
 
+    def get_min_max(self):
+        """
+        min and max values of the normalized volume, read from the histogram of the raw volume instead of scanning it
+
+        Returns:
+            (numpy array): float32 min and max
+        """
+        min_, max_ = self.__get_clip_bounds()
+        return np.array([min_, max_], np.float32) / np.float32(self.max_value)
+
     def get_min_max_HU(self):
-        HU_volume = self.get_HU_volume()
-        return HU_volume.min(), HU_volume.max()
+        """
+        min and max values of HU_volume, read from the histogram of the raw volume instead of scanning it
+
+        Returns:
+            (float, float): min and max HU
+        """
+        return tuple(self.convert_01_to_HU(self.get_min_max()))
+
+    def get_window_presets(self):
+        """
+        Window presets for the contrast stretching, clipped to the HU range of the volume
+
+        Returns:
+            (dict): preset name -> (min HU, max HU)
+        """
+        low, high = self.get_min_max_HU()
+        c, w, _, _ = self.__get_window_params()
+        return {
+            name: (float(np.clip(min_, low, high)), float(np.clip(max_, low, high)))
+            for name, (min_, max_) in self.stats.get_window_presets((c, w)).items()
+        }
+
+    def get_pyramid_level(self, level):
+        """
+        volume downsampled by 2 ** level with area averaging. levels are built on first request from the
+        previous one and stored in the on-disk cache. level 0 is the volume itself.
+
+        Args:
+            level (int): level of the pyramid, between 0 and PYRAMID_LEVELS
+
+        Returns:
+            (numpy array): downsampled volume
+        """
+        if level < 0 or level > PYRAMID_LEVELS:
+            raise ValueError("pyramid level must be between 0 and {}".format(PYRAMID_LEVELS))
+        if level == 0:
+            return self.volume
+        if level not in self.pyramid:
+            name = "pyramid_{}".format(2 ** level)
+            volume = self.cache.load_array(name) if self.cache is not None else None
+            if volume is None:
+                volume = processing.area_downsample(self.get_pyramid_level(level - 1), CHUNK_SLICES)
+                self.cache is not None and self.__save_cache_array(name, volume)
+            self.pyramid[level] = volume
+        return self.pyramid[level]
+
+    def select_pyramid_level(self, shape=None, max_voxels=None):
+        """
+        coarsest level of the pyramid whose slices still cover a display of the given shape
+        and which fits in a voxel budget
+
+        Args:
+            shape ((int, int)): height and width of the display
+            max_voxels (int): maximum amount of voxels of the volume
+
+        Returns:
+            (int): level of the pyramid
+        """
+        level_shape = lambda level: tuple(n >> level for n in (self.Z, self.H, self.W))
+        level = 0
+        if max_voxels is not None:
+            while level < PYRAMID_LEVELS and np.prod(level_shape(level)) > max_voxels:
+                level += 1
+        if shape is not None:
+            while level < PYRAMID_LEVELS and all(n >= s for n, s in zip(level_shape(level + 1)[1:], shape)):
+                level += 1
+        return level
+
+    def get_preview_volume(self, shape=None, max_voxels=None):
+        """
+        volume at the pyramid level picked by select_pyramid_level, for previews, thumbnails and 3D plots.
+        annotations are always computed on the full resolution volume.
+
+        Args:
+            shape ((int, int)): height and width of the display
+            max_voxels (int): maximum amount of voxels of the volume
+
+        Returns:
+            (numpy array): downsampled volume
+        """
+        return self.get_pyramid_level(self.select_pyramid_level(shape, max_voxels))
 
     def set_volume(self, volume):
         self.volume = volume
+        # previews and column copy of the old volume are stale, the on-disk ones as well
+        self.pyramid = {}
+        self.columns = None
+        self.cache = None
+
+    def get_column_volume(self):
+        """
+        (H, W, Z) C-contiguous copy of the volume, where each Z column is contiguous in memory instead of
+        being spread with a stride of H * W voxels. built on first request and stored in the on-disk cache.
+
+        Returns:
+            (numpy array): the column volume, None if the jaw was not created with z_contiguous
+        """
+        if not self.z_contiguous:
+            return None
+        if self.columns is None:
+            columns = self.cache.load_array('columns') if self.cache is not None else None
+            if columns is None:
+                columns = np.ascontiguousarray(np.moveaxis(self.volume, 0, -1))
+                self.cache is not None and self.__save_cache_array('columns', columns)
+            self.columns = columns
+        return self.columns
 
     def set_gt_volume(self, volume):
         self.gt_volume = volume
@@ -375,10 +804,13 @@ class Jaw:
         x1, x2 = int(np.floor(x_func)), int(np.floor(x_func) + 1)
         y1, y2 = int(np.floor(y_func)), int(np.floor(y_func) + 1)
         dx, dy = x_func - x1, y_func - y1
-        P1 = self.volume[:, y1, x1] * (1 - dx) * (1 - dy)
-        P2 = self.volume[:, y2, x1] * (1 - dx) * dy
-        P3 = self.volume[:, y1, x2] * dx * (1 - dy)
-        P4 = self.volume[:, y2, x2] * dx * dy
+        columns = self.get_column_volume()
+        if columns is None:  # Z columns of the (Z, H, W) volume
+            columns = np.moveaxis(self.volume, 0, -1)
+        P1 = columns[y1, x1] * (1 - dx) * (1 - dy)
+        P2 = columns[y2, x1] * (1 - dx) * dy
+        P3 = columns[y1, x2] * dx * (1 - dy)
+        P4 = columns[y2, x2] * dx * dy
         return P1 + P2 + P3 + P4
 
     def trilinear_interpolation(self, z_func, x_func, y_func):
@@ -499,15 +931,208 @@ class Jaw:
     # PRIVATE UTILS
     ###############
 
+    @staticmethod
+    def __slice_bounds(first, size):
+        """
+        first and last index picked by the slices [first:first + 2] of an axis, negative bounds count from the end
+
+        Args:
+            first (numpy array): integer start of the slices
+            size (int): size of the axis
+
+        Returns:
+            (numpy array, numpy array, numpy array): first and last index, false where the slice is empty
+        """
+        start, stop = first, first + 2
+        start = np.clip(np.where(start < 0, start + size, start), 0, size)
+        stop = np.clip(np.where(stop < 0, stop + size, stop), 0, size)
+        valid = stop > start
+        start = np.where(valid, start, 0)
+        return start, np.where(valid, stop - 1, 0), valid
+
+    def __add_resampling_plan(self, key, plan):
+        with self.plans_lock:
+            self.plans[key] = plan
+            while len(self.plans) > PLAN_CACHE_SIZE:
+                self.plans.popitem(last=False)
+
+    def __get_window_params(self):
+        """
+        read the window of the DICOM files
+
+        Returns:
+            (float, float, float, float): window center, window width, lower and upper bound of the window
+        """
+        w = self.dicom_files[0].WindowWidth
+        c = self.dicom_files[0].WindowCenter
+        return c, w, c - (w / 2), c + (w / 2)
+
+    def __build_low_memory_volumes(self):
+        """
+        low memory version of the volume pipeline. the raw volume is processed CHUNK_SLICES slices at a time:
+        HU values are rescaled into an int16 volume (float32 if they don't fit), quantiles are clipped and the
+        float32 normalized volume is written in place of the raw one, which is released.
+        """
+        if self.__is_z_flipped():  # Z-axis has to be flipped
+            self.volume = np.flip(self.volume, 0)
+            self.dicom_files.reverse()
+            self.filenames.reverse()
+        raw = self.volume
+
+        # HU rescale
+        bounds = np.array([self.stats.min(), self.stats.max()], np.float64) * self.HU_slope + self.HU_intercept
+        integer = float(self.HU_slope).is_integer() and float(self.HU_intercept).is_integer()
+        fits = np.iinfo(np.int16).min <= bounds.min() and bounds.max() <= np.iinfo(np.int16).max
+        self.HU = np.empty(raw.shape, np.int16 if integer and fits else np.float32)
+        for z in range(0, self.Z, CHUNK_SLICES):
+            self.HU[z:z + CHUNK_SLICES] = raw[z:z + CHUNK_SLICES] * np.float32(self.HU_slope) + self.HU_intercept
+
+        # quantiles and normalization, values are truncated as the integer raw volume would do
+        min_, max_ = self.__get_clip_bounds()
+        self.max_value = raw.dtype.type(max_)
+        volume = np.empty(raw.shape, np.float32)
+        for z in range(0, self.Z, CHUNK_SLICES):
+            chunk = volume[z:z + CHUNK_SLICES]
+            chunk[:] = raw[z:z + CHUNK_SLICES]
+            np.clip(chunk, min_, max_, out=chunk)
+            chunk /= np.float32(self.max_value)
+        self.volume = volume
+        del raw
+
+        self.gt_volume = self.__build_ann_volume()
+
+    def __get_derived_volume(self, name, build_fn):
+        """
+        volume derived from the int16 HU volume in low memory mode. it is built once and stored in the on-disk
+        cache, then memory-mapped from there so that its pages are not held in memory.
+
+        Args:
+            name (str): name of the volume in the cache
+            build_fn: function building the volume
+
+        Returns:
+            (numpy array): float32 volume
+        """
+        volume = self.cache.load_array(name) if self.cache is not None else None
+        if volume is None:
+            volume = build_fn()
+            if self.cache is not None:
+                self.__save_cache_array(name, volume)
+                cached = self.cache.load_array(name)
+                volume = volume if cached is None else cached
+        return volume
+
+    def __rescale_HU(self):
+        """
+        HU values of the normalized volume, CHUNK_SLICES slices at a time
+
+        Returns:
+            (numpy array): float32 HU volume
+        """
+        HU_volume = np.empty(self.volume.shape, np.float32)
+        scale = np.float32(self.max_value * self.HU_slope)
+        for z in range(0, self.Z, CHUNK_SLICES):
+            np.multiply(self.volume[z:z + CHUNK_SLICES], scale, out=HU_volume[z:z + CHUNK_SLICES])
+            HU_volume[z:z + CHUNK_SLICES] += np.float32(self.HU_intercept)
+        return HU_volume
+
+    def __window_HU(self):
+        """
+        apply the DICOM window to the int16 HU volume, CHUNK_SLICES slices at a time
+
+        Returns:
+            (numpy array): float32 windowed volume
+        """
+        c, w, ymin, ymax = self.__get_window_params()
+        final_HU = np.empty(self.HU.shape, np.float32)
+        for z in range(0, self.Z, CHUNK_SLICES):
+            HU, chunk = self.HU[z:z + CHUNK_SLICES], final_HU[z:z + CHUNK_SLICES]
+            np.subtract(HU, c - .5, out=chunk)
+            chunk /= w - 1
+            chunk += .5
+            chunk *= ymax - ymin
+            chunk += ymin
+            chunk[HU < (c - .5 - (w - 1) / 2)] = ymin
+            chunk[HU > (c - .5 + (w - 1) / 2)] = ymax
+        return final_HU
+
+    def __is_z_flipped(self):
+        """
+        check the order of the slices in the DICOM files
+
+        Returns:
+            (bool): true if the Z-axis of the files has to be flipped
+        """
+        return self.dicom_files[1].ImagePositionPatient[-1] - self.dicom_files[0].ImagePositionPatient[-1] > 0
+
+    def __load_cache(self, cache):
+        """
+        memory-map the derived volumes from the on-disk cache, arranging the DICOM files as they were computed
+
+        Args:
+            cache (VolumeCache): cache of the series
+        """
+        arrays, values = cache.load()
+        for name in LOW_MEMORY_CACHED_VOLUMES if self.low_memory else CACHED_VOLUMES:
+            setattr(self, name, arrays[name])
+        self.max_value = values['max_value']
+        self.Z, self.H, self.W = self.volume.shape
+        self.HU_intercept, self.HU_slope = self.__get_HU_rescale_params()
+        self.stats = VolumeStatistics(HU_slope=self.HU_slope, HU_intercept=self.HU_intercept,
+                                      values=arrays['stats_values'], counts=arrays['stats_counts'])
+        if self.__is_z_flipped():
+            self.dicom_files.reverse()
+            self.filenames.reverse()
+
+    def __save_cache(self, cache):
+        """
+        store the derived volumes in the on-disk cache. a failure just means the next opening is slower.
+
+        Args:
+            cache (VolumeCache): cache of the series
+        """
+        try:
+            names = LOW_MEMORY_CACHED_VOLUMES if self.low_memory else CACHED_VOLUMES
+            arrays = {name: getattr(self, name) for name in names}
+            arrays['stats_values'], arrays['stats_counts'] = self.stats.get_arrays()
+            cache.save(arrays, {'max_value': float(self.max_value)})
+        except OSError as e:
+            print("WARNING: could not cache the volumes in {}: {}".format(cache.root, e))
+
+    def __get_clip_bounds(self):
+        """
+        raw values of the normalized volume bounds: the quantiles clipped by __remove_quantiles,
+        truncated as they are when written in an integer volume
+
+        Returns:
+            (number, number): min and max raw values of the clipped volume
+        """
+        min_, max_ = self.stats.quantile((MIN_QUANTILE, MAX_QUANTILE))
+        if np.issubdtype(self.stats.values.dtype, np.integer):
+            min_, max_ = np.trunc(min_), np.trunc(max_)
+        return max(self.stats.min(), min_), min(self.stats.max(), max_)
+
+    def __save_cache_array(self, name, array):
+        """
+        add an array to the on-disk cache entry of the series. a failure just means it is computed again next time.
+
+        Args:
+            name (str): name of the array
+            array (numpy array): array to store
+        """
+        try:
+            self.cache.save_array(name, array)
+        except OSError as e:
+            print("WARNING: could not cache {} in {}: {}".format(name, self.cache.root, e))
+
     def __remove_quantiles(self, min=MIN_QUANTILE, max=MAX_QUANTILE):
         """
-        remove peak values
+        remove peak values, quantiles are read from the histogram of the raw volume
         Args:
             min (float): min threshold
             max (float): max threshold
         """
-        min = np.quantile(self.volume, min),
-        max = np.quantile(self.volume, max)
+        min, max = self.stats.quantile((min, max))
         self.volume[self.volume > max] = max
         self.volume[self.volume < min] = min
 
@@ -524,13 +1149,29 @@ class Jaw:
     def __build_ann_volume(self):
         """
         read overlay data from the dicom files and extract them in a numpy array. if
-        no annotations are found a 0-volume is created
+        no annotations are found a 0-volume is created.
         """
-        annotations = []
         try:
-            for slice_num in range(self.Z):
-                annotations.append(self.get_gt_slice(slice_num))
-            return np.stack(annotations).astype(np.uint8)
-        except:
+            return read_overlays(self.dicom_files, OVERLAY_ADDR)
+        except (AttributeError, KeyError, ValueError):
             print("INFO: NO ANNOTATION FOUND IN THIS VOLUME! BLACK MASK RETURNED")
-            return np.zeros_like(self.volume)
+            return np.zeros(self.volume.shape, np.uint8)
+
+    def __build_labels_volume(self):
+        """
+        merge the per-label overlays of the dicom files in a single label volume.
+        voxels not covered by any of them are left UNLABELED, so the UNLABELED overlay is not decoded.
+
+        Returns:
+            (numpy array): uint8 label volume, None if the files don't have the overlays
+        """
+        if (LABEL_OVERLAY_ADDRS[l.CONTOUR], 0x3000) not in self.dicom_files[0]:
+            return None
+        labels = np.full(self.volume.shape, l.UNLABELED, np.uint8)
+        try:
+            for label, overlay_addr in LABEL_OVERLAY_ADDRS.items():
+                if label != l.UNLABELED:
+                    labels[read_overlays(self.dicom_files, overlay_addr).astype(bool)] = label
+        except (AttributeError, KeyError, ValueError):
+            return None
+        return labels
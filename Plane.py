@@ -1,17 +1,259 @@
 import numpy as np
 
 
+def plane_z_levels(planes, z_levels=None):
+    """
+    Z index of the row of each plane where its rotation axis is placed
+    Args:
+        planes (numpy array): (N, 3, Z, W) planes of coords
+        z_levels (list of float): level of the z axis of each plane, see Plane.tilt_x. the middle row is used
+            for the planes without a level
+    Returns:
+        (numpy array): (N,) row indices
+    """
+    n, _, Z, W = planes.shape
+    rows = np.full(n, Z // 2, dtype=np.intp)
+    if z_levels is None:
+        return rows
+    for i, z_level in enumerate(z_levels):
+        if z_level:  # the closest cell of the plane to the level
+            rows[i] = np.abs(planes[i, 2] - z_level).argmin() // W
+    return rows
+
+
+PLANE_TOLERANCE = 1e-6  # largest difference between dense coords and the ones generated by their line and step
+
+
+def lines_grid(lines, steps, plane_z):
+    """
+    generate the coords of a batch of planes from their first rows and the steps between their rows
+    Args:
+        lines (numpy array): (N, W, 3) xyz coords of the first row of each plane
+        steps (numpy array): (N, 3) xyz difference between consecutive rows of each plane
+        plane_z (Int): z shape of the planes
+    Returns:
+        (numpy array): (N, 3, Z, W) planes of coords, ordered as [0] X, [1] Y, [2] Z
+    """
+    z = np.arange(plane_z, dtype=np.float64)[:, np.newaxis]
+    grid = np.moveaxis(lines, 2, 1)[:, :, np.newaxis, :] + steps[:, :, np.newaxis, np.newaxis] * z
+    grid[:, 2][grid[:, 2] >= plane_z] = plane_z - 1  # threshold for overflows
+    return grid
+
+
+def lines_points(lines, steps, rows, cols, plane_z):
+    """
+    coords of a single cell of each plane of a batch, see lines_grid
+    Args:
+        lines (numpy array): (N, W, 3) xyz coords of the first row of each plane
+        steps (numpy array): (N, 3) xyz difference between consecutive rows of each plane
+        rows (numpy array): (N,) row of the cell of each plane
+        cols (numpy array): (N,) column of the cell of each plane
+        plane_z (Int): z shape of the planes
+    Returns:
+        (numpy array): (N, 3) xyz coords
+    """
+    points = lines[np.arange(len(lines)), cols] + rows[:, np.newaxis] * steps
+    points[:, 2][points[:, 2] >= plane_z] = plane_z - 1
+    return points
+
+
+def lines_overflow(lines, steps, plane_z):
+    """
+    planes of a batch with coords over the Z shape, their line and step generate them only
+    with the threshold for overflows (see lines_grid)
+    Args:
+        lines (numpy array): (N, W, 3) xyz coords of the first row of each plane
+        steps (numpy array): (N, 3) xyz difference between consecutive rows of each plane
+        plane_z (Int): z shape of the planes
+    Returns:
+        (numpy array): (N,) bool
+    """
+    last = lines[:, :, 2] + steps[:, np.newaxis, 2] * (plane_z - 1)  # rows are linear, first or last one is the max
+    return (lines[:, :, 2] >= plane_z).any(axis=1) | (last >= plane_z).any(axis=1)
+
+
+def lines_z_levels(lines, steps, plane_z, z_levels=None):
+    """
+    Z index of the row of each plane where its rotation axis is placed, see plane_z_levels
+    Args:
+        lines (numpy array): (N, W, 3) xyz coords of the first row of each plane
+        steps (numpy array): (N, 3) xyz difference between consecutive rows of each plane
+        plane_z (Int): z shape of the planes
+        z_levels (list of float): level of the z axis of each plane
+    Returns:
+        (numpy array): (N,) row indices
+    """
+    n, W, _ = lines.shape
+    rows = np.full(n, plane_z // 2, dtype=np.intp)
+    if z_levels is None:
+        return rows
+    z = np.arange(plane_z, dtype=np.float64)[:, np.newaxis]
+    for i, z_level in enumerate(z_levels):
+        if z_level:  # the closest cell of the plane to the level, only the z coords are generated
+            plane_z_coords = lines[i, :, 2] + steps[i, 2] * z
+            plane_z_coords[plane_z_coords >= plane_z] = plane_z - 1
+            rows[i] = np.abs(plane_z_coords - z_level).argmin() // W
+    return rows
+
+
+def tilt_matrices(u, degrees, axis):
+    """
+    rotation matrices of a batch of tilts. each one is the composition of the alignment of the rotation axis,
+    the rotation and the reverse alignment, so that a plane is tilted with a single matrix product
+    Args:
+        u (numpy array): (N, 3) unit vectors of the rotation axes, ordered as [0] X, [1] Y, [2] Z
+        degrees (numpy array): (N,) angles to rotate about in degrees
+        axis (str): 'x' aligns u to the Z axis and rotates around it (tilt_x),
+            'z' aligns u to the Y axis and rotates around it (tilt_z)
+    Returns:
+        (numpy array): (N, 3, 3) matrices
+    """
+    n = len(u)
+    ux, uy, uz = u[:, 0], u[:, 1], u[:, 2]
+    angle = np.radians(degrees)
+    cos, sin = np.cos(angle), np.sin(angle)
+    align = np.tile(np.eye(3), (n, 1, 1))
+    rotation = np.tile(np.eye(3), (n, 1, 1))
+    if axis == 'x':
+        d = np.sqrt(uy ** 2 + uz ** 2)
+        i = np.flatnonzero(d != 0)  # axes already aligned are left as they are
+        align[i, 1, 1], align[i, 1, 2] = uz[i] / d[i], -uy[i] / d[i]
+        align[i, 2, 1], align[i, 2, 2] = uy[i] / d[i], uz[i] / d[i]
+        rotation[:, 0, 0], rotation[:, 0, 1], rotation[:, 1, 0], rotation[:, 1, 1] = cos, -sin, sin, cos
+    elif axis == 'z':
+        d = np.sqrt(uy ** 2 + ux ** 2)
+        i = np.flatnonzero(d != 0)
+        align[i, 0, 0], align[i, 0, 1] = uy[i] / d[i], -ux[i] / d[i]
+        align[i, 1, 0], align[i, 1, 1] = ux[i] / d[i], uy[i] / d[i]
+        rotation[:, 0, 0], rotation[:, 0, 2], rotation[:, 2, 0], rotation[:, 2, 2] = cos, sin, -sin, cos
+    else:
+        raise ValueError("unknown tilt axis {}, use 'x' or 'z'".format(axis))
+    # the reverse alignment is the transpose of the alignment
+    return np.matmul(np.matmul(np.transpose(align, (0, 2, 1)), rotation), align)
+
+
+def tilt_planes(planes, degrees, z_levels=None, axis='z', out=None):
+    """
+    tilt a batch of planes, each one by its own angle, see Plane.tilt_x and Plane.tilt_z.
+    the planes are translated to the origin, multiplied by their composed tilt matrix and translated back
+    with a single batched matrix product
+    Args:
+        planes (numpy array): (N, 3, Z, W) planes of coords
+        degrees (list of float): angle of each plane in degrees, planes with 0 degrees are not tilted
+        z_levels (list of float): level of the z axis of each plane where the rotation axis has to be placed
+        axis (str): 'x' for tilt_x, 'z' for tilt_z
+        out (numpy array): optional (N, 3, Z, W) output, it can be planes itself
+    Returns:
+        (numpy array): (N, 3, Z, W) tilted planes, a new array if out is None
+    """
+    planes = np.asarray(planes, dtype=np.float64)
+    if out is None:
+        out = planes.copy()
+    elif out is not planes:
+        out[...] = planes
+    n, _, Z, W = planes.shape
+    degrees = np.broadcast_to(np.asarray(degrees, dtype=np.float64), (n,))
+    ids = np.flatnonzero(degrees != 0)
+    if ids.size == 0:
+        return out
+    z_levels = None if z_levels is None else [z_levels[i] for i in ids]
+    degrees = degrees[ids]
+    if ids.size == n:
+        ids = slice(None)  # no copies of the planes
+    sub = planes[ids]
+    rows, ar = plane_z_levels(sub, z_levels), np.arange(sub.shape[0])
+
+    # rotation axis from the vectors of differences upon the centre of the plane
+    centres = sub[ar, :, rows, W // 2]
+    if axis == 'x':
+        u = sub[ar, :, rows + 1, W // 2] - centres
+    else:
+        u = sub[ar, :, rows, W // 2 + 1] - centres
+    u /= np.linalg.norm(u, axis=1, keepdims=True)
+
+    matrices = tilt_matrices(u, degrees, axis)
+    centres = centres[:, :, np.newaxis, np.newaxis]
+    tilted = np.matmul(matrices, (sub - centres).reshape(sub.shape[0], 3, -1)).reshape(sub.shape)
+    tilted += centres  # shifting back from the origin
+    tilted[:, 2][tilted[:, 2] >= Z] = Z - 1  # threshold for overflows
+    out[ids] = tilted
+    return out
+
+
+def tilt_lines(lines, steps, degrees, plane_z, z_levels=None, axis='z'):
+    """
+    tilt a batch of planes stored as their first rows and the steps between their rows, see tilt_planes.
+    only the W + 1 points of each plane are transformed, the threshold for overflows is applied
+    when the coords are generated (see lines_grid). planes that already overflow must be tilted
+    on their coords instead, see lines_overflow
+    Args:
+        lines (numpy array): (N, W, 3) xyz coords of the first row of each plane
+        steps (numpy array): (N, 3) xyz difference between consecutive rows of each plane
+        degrees (list of float): angle of each plane in degrees, planes with 0 degrees are not tilted
+        plane_z (Int): z shape of the planes
+        z_levels (list of float): level of the z axis of each plane where the rotation axis has to be placed
+        axis (str): 'x' for tilt_x, 'z' for tilt_z
+    Returns:
+        (numpy array, numpy array): new (N, W, 3) lines and (N, 3) steps of the tilted planes
+    """
+    lines, steps = np.array(lines, dtype=np.float64), np.array(steps, dtype=np.float64)
+    n, W, _ = lines.shape
+    degrees = np.broadcast_to(np.asarray(degrees, dtype=np.float64), (n,))
+    ids = np.flatnonzero(degrees != 0)
+    if ids.size == 0:
+        return lines, steps
+    z_levels = None if z_levels is None else [z_levels[i] for i in ids]
+    sub_lines, sub_steps = lines[ids], steps[ids]
+    rows = lines_z_levels(sub_lines, sub_steps, plane_z, z_levels)
+    cols = np.full(ids.size, W // 2)
+
+    # rotation axis from the vectors of differences upon the centre of the plane
+    centres = lines_points(sub_lines, sub_steps, rows, cols, plane_z)
+    if axis == 'x':
+        u = lines_points(sub_lines, sub_steps, rows + 1, cols, plane_z) - centres
+    else:
+        u = lines_points(sub_lines, sub_steps, rows, cols + 1, plane_z) - centres
+    u /= np.linalg.norm(u, axis=1, keepdims=True)
+
+    matrices = tilt_matrices(u, degrees[ids], axis)
+    centres = centres[:, np.newaxis, :]
+    lines[ids] = np.matmul(sub_lines - centres, np.transpose(matrices, (0, 2, 1))) + centres
+    steps[ids] = np.matmul(matrices, sub_steps[:, :, np.newaxis])[:, :, 0]
+    return lines, steps
+
+
 class Plane:
 
     def __init__(self, plane_z, plane_w):
         """
-        create a new (empty) plane of coords, shape of the plane must be declared here
+        create a new (empty) plane of coords, shape of the plane must be declared here.
+        the plane is kept as its first row of coords and the step between its rows, the whole
+        grid of coords is generated only when it is needed (see plane)
         Args:
             plane_z (Int): z shape of the plane (usually the Z len of the volume to cut)
             plane_w (Int): w shape of the plane (usually the len of the xy set of coordinates)
         """
         self.Z, self.W = plane_z, plane_w
-        self.plane = np.empty((3, self.Z, self.W))
+        self.line = np.zeros((self.W, 3))  # xyz coords of the first row
+        self.step = np.zeros(3)  # xyz difference between consecutive rows
+        self.coords = None  # dense coords, only for planes loaded from an array (see set_plane)
+        self.affine = None  # 3x4 transform of the dense coords not applied yet, see tilt
+        self.bounds = None  # 3x2 min and max of the dense coords, see _may_overflow
+
+    @property
+    def plane(self):
+        """
+        order of coordinates in the plane are [0] X, [1] Y, [2] Z
+        Returns (numpy array): 3xZxW plane of coordinates, generated from line and step if the plane is not dense
+        """
+        if self.coords is not None:
+            self._apply_affine()
+            return self.coords
+        return lines_grid(self.line[np.newaxis], self.step[np.newaxis], self.Z)[0]
+
+    @plane.setter
+    def plane(self, plane):
+        self.set_plane(plane)
 
     def from_line(self, xy_set):
         """
@@ -22,12 +264,26 @@ class Plane:
         if len(xy_set.shape) > 2:
             raise Exception("coords_to_plane: feed this function with just one set of coords per time")
 
-        x_set, y_set = xy_set[:, 0], xy_set[:, 1]
-        self.plane = np.stack((
-            np.tile(x_set, (self.Z, 1)),
-            np.tile(y_set, (self.Z, 1)),
-            np.moveaxis(np.tile(np.arange(0, self.Z, dtype=np.float), (x_set.size, 1)), 0, 1)
-        ))
+        self.line = np.zeros((len(xy_set), 3))
+        self.line[:, :2] = xy_set[:, :2]
+        self.step = np.array([0., 0., 1.])
+        self.coords, self.affine, self.bounds = None, None, None
+
+    def get_point(self, z, w):
+        """
+        Args:
+            z (Int): row of the plane
+            w (Int): column of the plane
+        Returns:
+            (numpy array): xyz coords of a single cell of the plane
+        """
+        if self.coords is not None:
+            point = self.coords[:, z, w]
+            if self.affine is not None:
+                point = self.affine[:, :3] @ point + self.affine[:, 3]
+                point[2] = min(point[2], self.Z - 1)
+            return point
+        return lines_points(self.line[np.newaxis], self.step[np.newaxis], np.array([z]), np.array([w]), self.Z)[0]
 
     def get_h_axis(self, z_level):
         """
@@ -40,20 +296,8 @@ class Plane:
         ux, uy, ux (Float): values for each component of the vector
         """
 
-        plane_centre = {
-                'z': z_level,
-                'w': self.W // 2
-            }
-
         # get the axis from the vectors of differences upon the centre of the plane (ux, uy, uz)
-        u = np.array([
-            self.plane[0, plane_centre['z'] + 1, plane_centre['w']] - self.plane[
-                0, plane_centre['z'], plane_centre['w']],
-            self.plane[1, plane_centre['z'] + 1, plane_centre['w']] - self.plane[
-                1, plane_centre['z'], plane_centre['w']],
-            self.plane[2, plane_centre['z'] + 1, plane_centre['w']] - self.plane[
-                2, plane_centre['z'], plane_centre['w']],
-        ])
+        u = self.get_point(z_level + 1, self.W // 2) - self.get_point(z_level, self.W // 2)
         ux, uy, uz = u / np.linalg.norm(u)  # normalization
         return ux, uy, uz
 
@@ -67,19 +311,8 @@ class Plane:
         Returns:
         ux, uy, ux (Float): values for each component of the vector
         """
-        plane_centre = {
-            'z': z_level,
-            'w': self.W // 2
-        }
         # get the axis from the vectors of differences upon the centre of the plane (ux, uy, uz)
-        u = np.array([
-            self.plane[0, plane_centre['z'], plane_centre['w'] + 1] - self.plane[
-                0, plane_centre['z'], plane_centre['w']],
-            self.plane[1, plane_centre['z'], plane_centre['w'] + 1] - self.plane[
-                1, plane_centre['z'], plane_centre['w']],
-            self.plane[2, plane_centre['z'], plane_centre['w'] + 1] - self.plane[
-                2, plane_centre['z'], plane_centre['w']],
-        ])
+        u = self.get_point(z_level, self.W // 2 + 1) - self.get_point(z_level, self.W // 2)
         ux, uy, uz = u / np.linalg.norm(u)  # normalization
         return ux, uy, uz
 
@@ -93,6 +326,7 @@ class Plane:
             3- tilt the plane around the Z axis with a 3D rotation matrix
             4- perform the reverse of 2
             5- perform the reverse of 3
+            steps 2, 3 and 4 are composed in a single matrix, see tilt_matrices
             further information at http://paulbourke.net/geometry/rotate/
         Args:
             degrees (Int): angle to rotate about in degrees
@@ -100,57 +334,9 @@ class Plane:
             is placed in the middle of the plane, otherwise we search over the coords in the plane for the closest value and we
             place the rotation axis at that cell of the plane so that the source of the rotation lays there.
         """
-
         if degrees == 0:
             return
-
-        # Z index of the plane should be as close as possible to the avarage canal Z position
-        if not z_level:
-            z_level = self.Z // 2  # if we have no clues then let's rotate with respect to the middle of the plane
-        else:
-            z_level = np.abs(self.plane[2] - z_level).argmin() // self.W
-
-        # shifting to the origin
-        centres = self.plane[:, z_level, self.W // 2]
-        self.plane = np.subtract(self.plane, centres.reshape(3, 1, 1))  # broadcasting is real fancy
-
-        ux, uy, uz = self.get_h_axis(z_level)
-
-        # align to Z
-        d = np.sqrt(uy ** 2 + uz ** 2)
-        if d != 0:
-            axis_align_matr = np.array([
-                [1, 0, 0],
-                [0, uz / d, -uy / d],
-                [0, uy / d, uz / d]
-            ])
-            self.plane = np.tensordot(self.plane, axis_align_matr, axes=(0, 1))
-            self.plane = np.moveaxis(self.plane, 2, 0)
-
-        # rotate
-        angle = np.radians(degrees)
-        rotation_matrix = np.array([
-            [np.cos(angle), -np.sin(angle), 0],
-            [np.sin(angle), np.cos(angle), 0],
-            [0, 0, 1]
-        ])
-        self.plane = np.tensordot(self.plane, rotation_matrix, axes=(0, 1))
-        self.plane = np.moveaxis(self.plane, 2, 0)
-
-        if d != 0:
-            axis_align_matr = np.array([
-                [1, 0, 0],
-                [0, uz / d, uy / d],
-                [0, -uy / d, uz / d]
-            ])
-            self.plane = np.tensordot(self.plane, axis_align_matr, axes=(0, 1))
-            self.plane = np.moveaxis(self.plane, 2, 0)
-
-        # shifting to the origin
-        self.plane = np.add(self.plane, centres.reshape(3, 1, 1))
-
-        # threshold for overflows
-        self.plane[2][self.plane[2] >= self.Z] = self.Z - 1
+        self.tilt(degrees, z_level, 'x')
 
     def tilt_z(self, degrees, z_level=None):
         """
@@ -162,6 +348,7 @@ class Plane:
             3- tilt the plane around the Y axis with a 3D rotation matrix
             4- perform the reverse of 2
             5- perform the reverse of 3
+            steps 2, 3 and 4 are composed in a single matrix, see tilt_matrices
             further information at http://paulbourke.net/geometry/rotate/
         Args:
             degrees (Int): angle to rotate about in degrees
@@ -169,73 +356,88 @@ class Plane:
             is placed in the middle of the plane, otherwise we search over the coords in the plane for the closest value and we
             place the rotation axis at that cell of the plane so that the source of the rotation lays there.
         """
-
         if degrees == 0:
             return
+        self.tilt(degrees, z_level, 'z')
 
-        # Z index of the plane should be as close as possible to the avarage canal Z position
-        if not z_level:
-            z_level = self.Z // 2  # if we have no clues then let's rotate with respect to the middle of the plane
+    def tilt(self, degrees, z_level, axis):
+        """
+        tilt_x or tilt_z. only line and step are transformed. dense planes and planes over the Z shape
+        compose the tilts in a single affine transform instead, it is applied to all their coords at once
+        when they are needed (see plane)
+        Args:
+            degrees (Int): angle to rotate about in degrees
+            z_level (Int): level of the z axis where our rotation axis has to be placed
+            axis (str): 'x' for tilt_x, 'z' for tilt_z
+        """
+        if self.coords is None and lines_overflow(self.line[np.newaxis], self.step[np.newaxis], self.Z)[0]:
+            self.set_plane(self.plane)  # the threshold for overflows is not linear, see lines_overflow
+        if self.coords is not None:
+            self._compose_tilt(degrees, z_level, axis)
+            return
+        lines, steps = tilt_lines(self.line[np.newaxis], self.step[np.newaxis], [degrees], self.Z, [z_level], axis)
+        self.line, self.step = lines[0], steps[0]
+
+    def _compose_tilt(self, degrees, z_level, axis):
+        """compose a tilt of the dense coords with the transform not applied yet, see tilt_planes"""
+        if self.affine is not None and self._may_overflow():
+            self._apply_affine()  # the threshold for overflows is applied after each tilt
+        row = self.Z // 2
+        if z_level:  # the closest cell of the plane to the level, only the z coords are transformed
+            z = self.coords[2]
+            if self.affine is not None:
+                z = np.tensordot(self.affine[2, :3], self.coords, axes=1) + self.affine[2, 3]
+                z[z >= self.Z] = self.Z - 1
+            row = np.abs(z - z_level).argmin() // self.W
+
+        # rotation axis from the vectors of differences upon the centre of the plane
+        centre = self.get_point(row, self.W // 2)
+        if axis == 'x':
+            u = self.get_point(row + 1, self.W // 2) - centre
         else:
-            z_level = np.abs(self.plane[2] - z_level).argmin() // self.W
-
-        # shifting to the origin
-        centres = self.plane[:, z_level, self.W // 2]
-        self.plane = np.subtract(self.plane, centres.reshape(3, 1, 1))
+            u = self.get_point(row, self.W // 2 + 1) - centre
+        u /= np.linalg.norm(u)
 
-        ux, uy, uz = self.get_w_axis(z_level)
+        # translation to the origin, rotation and translation back: p' = M (p - c) + c
+        matrix = tilt_matrices(u[np.newaxis], [degrees], axis)[0]
+        tilt = np.concatenate((matrix, (centre - matrix @ centre)[:, np.newaxis]), axis=1)
+        if self.affine is not None:
+            tilt = np.concatenate((matrix @ self.affine[:, :3], tilt[:, 3:] + matrix @ self.affine[:, 3:]), axis=1)
+        self.affine = tilt
 
-        # align to Y axis
-        d = np.sqrt(uy ** 2 + ux ** 2)
-        if d != 0:
-            axis_align_matr = np.array([
-                [uy / d, -ux / d, 0],
-                [ux / d, uy / d, 0],
-                [0, 0, 1]
-            ])
-            self.plane = np.tensordot(self.plane, axis_align_matr, axes=(0, 1))
-            self.plane = np.moveaxis(self.plane, 2, 0)
-
-        # rotate on y to tilt
-        angle = np.radians(degrees)
-        rotation_matrix = np.array([
-            [np.cos(angle), 0, np.sin(angle)],
-            [0, 1, 0],
-            [-np.sin(angle), 0, np.cos(angle)],
-
-        ])
-        self.plane = np.tensordot(self.plane, rotation_matrix, axes=(0, 1))
-        self.plane = np.moveaxis(self.plane, 2, 0)
-
-        # go back from the y alignment
-        if d != 0:
-            axis_align_matr = np.array([
-                [uy / d, ux / d, 0],
-                [-ux / d, uy / d, 0],
-                [0, 0, 1]
-            ])
-            self.plane = np.tensordot(self.plane, axis_align_matr, axes=(0, 1))
-            self.plane = np.moveaxis(self.plane, 2, 0)
-
-        # shifting to the origin
-        self.plane = np.add(self.plane, centres.reshape(3, 1, 1))
-
-        self.plane[2][self.plane[2] >= self.Z] = self.Z - 1  # threshold for overflows
+    def _may_overflow(self):
+        """
+        the transform not applied yet can move some coords over the Z shape. the max z of a linear
+        transform of the coords is lower than the max of the transformed corners of their bounds
+        """
+        if self.bounds is None:
+            self.bounds = np.stack((self.coords.min(axis=(1, 2)), self.coords.max(axis=(1, 2))), axis=1)
+        z_row = self.affine[2]
+        return z_row[3] + np.maximum(z_row[:3] * self.bounds[:, 0], z_row[:3] * self.bounds[:, 1]).sum() >= self.Z
+
+    def _apply_affine(self):
+        """apply the transform not applied yet to the dense coords, in a single pass on a new array"""
+        if self.affine is None:
+            return
+        coords = np.matmul(self.affine[:, :3], self.coords.reshape(3, -1)).reshape(self.coords.shape)
+        coords += self.affine[:, 3, np.newaxis, np.newaxis]
+        coords[2][coords[2] >= self.Z] = self.Z - 1  # threshold for overflows
+        self.coords, self.affine, self.bounds = coords, None, None
 
     def get_plane(self):
         """
         order of coordinates in the plane are [0] X, [1] Y, [2] Z
         Returns (numpy array): plane of coordinates
         """
-        return self.plane.copy()
+        return self.plane.copy() if self.coords is not None else self.plane
 
     def set_plane(self, plane):
         """
-        load the data from an existing plane
+        load the data from an existing plane, the plane is dense from now on
         Args:
             plane numpy array: plane of coordinates
         """
-        self.plane = plane
+        self.coords, self.affine, self.bounds = plane, None, None
 
     @staticmethod
     def empty_like(plane):
@@ -250,3 +452,196 @@ class Plane:
 
     def __getitem__(self, coord_set):
         return self.plane[coord_set]
+
+
+class PlaneStack:
+
+    def __init__(self, n, plane_z, plane_w):
+        """
+        create a stack of n (empty) planes of the same shape, so that all of them are built, tilted and resampled
+        together. as Plane, each plane is kept as its first row of coords and the step between its rows, in two
+        (N, W, 3) and (N, 3) arrays. stacks loaded from dense coords that cannot be stored so keep a single
+        (N, 3, Z, W) array of coords instead
+        Args:
+            n (Int): amount of planes
+            plane_z (Int): z shape of the planes (usually the Z len of the volume to cut)
+            plane_w (Int): w shape of the planes (usually the len of the xy sets of coordinates)
+        """
+        self.N, self.Z, self.W = n, plane_z, plane_w
+        self.lines = np.zeros((n, plane_w, 3))
+        self.steps = np.zeros((n, 3))
+        self.coords = None  # dense coords, only for stacks loaded from an array (see from_array)
+        self.valid = np.zeros(n, dtype=bool)  # planes that have been set, the others are None
+
+    @classmethod
+    def from_lines(cls, xy_set, plane_z):
+        """
+        create a stack of planes from a set of lines (see Plane.from_line)
+        Args:
+            xy_set (numpy array): (N, W, 2) set of N lines of W xy coordinates
+            plane_z (Int): z shape of the planes
+        Returns:
+            (PlaneStack): stack of the N planes
+        """
+        xy_set = np.asarray(xy_set)
+        stack = cls(xy_set.shape[0], plane_z, xy_set.shape[1] if xy_set.ndim == 3 else 0)
+        stack.set_lines(np.arange(stack.N), xy_set)
+        return stack
+
+    @classmethod
+    def from_array(cls, planes, plane_z=None):
+        """
+        create a stack from an array saved by to_array. stacks of dense coords are stored as lines and steps
+        whenever the coords they generate are the same, planes made of zeros only are None
+        Args:
+            planes (numpy array): (N, W + 1, 3) lines and steps of the planes or (N, 3, Z, W) planes of coords
+            plane_z (Int): z shape of the planes, needed for lines and steps only
+        Returns:
+            (PlaneStack): stack of the planes
+        """
+        if planes.ndim == 3:
+            n, w, _ = planes.shape
+            stack = cls(n, plane_z, w - 1)
+            stack.lines[:], stack.steps[:] = planes[:, :-1], planes[:, -1]
+            stack.valid = stack.lines.reshape(n, -1).any(axis=1) | stack.steps.any(axis=1)
+            return stack
+
+        n, _, plane_z, plane_w = planes.shape
+        stack = cls(n, plane_z, plane_w)
+        for i in range(n):  # one plane at a time, the array can be memory-mapped
+            plane = np.asarray(planes[i], dtype=np.float64)
+            if not plane.any():
+                continue
+            line = plane[:, 0, :].T
+            step = plane[:, 1, plane_w // 2] - plane[:, 0, plane_w // 2] if plane_z > 1 else np.zeros(3)
+            grid = lines_grid(line[np.newaxis], step[np.newaxis], plane_z)[0]
+            if np.abs(grid - plane).max() > PLANE_TOLERANCE:
+                stack.coords = np.array(planes, dtype=np.float64)
+                stack.valid = stack.coords.reshape(n, -1).any(axis=1)
+                return stack
+            stack.lines[i], stack.steps[i], stack.valid[i] = line, step, True
+        return stack
+
+    def to_array(self):
+        """
+        Returns:
+            (numpy array): (N, W + 1, 3) lines and steps of the planes, planes that are None are made of zeros.
+                (N, 3, Z, W) coords for the dense stacks
+        """
+        if self.coords is not None:
+            return self.coords
+        return np.concatenate((self.lines, self.steps[:, np.newaxis]), axis=1)
+
+    def set_lines(self, ids, xy_set):
+        """
+        load some of the planes from lines (duplicating xy values over all the Z axis)
+        Args:
+            ids (numpy array): indices of the planes
+            xy_set (numpy array): (len(ids), W, 2) lines of xy coordinates
+        """
+        xy_set = np.asarray(xy_set, dtype=np.float64)
+        lines = np.zeros(xy_set.shape[:-1] + (3,))
+        lines[..., :2] = xy_set
+        steps = np.zeros((len(lines), 3))
+        steps[:, 2] = 1
+        if self.coords is not None:
+            self.coords[ids] = lines_grid(lines, steps, self.Z)
+        else:
+            self.lines[ids], self.steps[ids] = lines, steps
+        self.valid[ids] = True
+
+    def tilt_x(self, degrees, z_levels=None, ids=None):
+        """
+        tilt some of the planes around their Z axis, each one by its own angle (see Plane.tilt_x)
+        Args:
+            degrees (list of float): angle of each plane in degrees
+            z_levels (list of float): level of the z axis of each plane where the rotation axis has to be placed
+            ids (numpy array): indices of the planes, all of them if None
+        """
+        self.tilt(degrees, z_levels, ids, 'x')
+
+    def tilt_z(self, degrees, z_levels=None, ids=None):
+        """
+        tilt some of the planes around their Y axis, each one by its own angle (see Plane.tilt_z)
+        Args:
+            degrees (list of float): angle of each plane in degrees
+            z_levels (list of float): level of the z axis of each plane where the rotation axis has to be placed
+            ids (numpy array): indices of the planes, all of them if None
+        """
+        self.tilt(degrees, z_levels, ids, 'z')
+
+    def tilt(self, degrees, z_levels, ids, axis):
+        """
+        tilt_x or tilt_z of some of the planes, see tilt_lines and tilt_planes.
+        the stack becomes dense if some of the planes to tilt are over the Z shape
+        """
+        ids = self._index(ids)
+        if self.coords is None and lines_overflow(self.lines[ids], self.steps[ids], self.Z).any():
+            self.coords = self.get_planes()  # the threshold for overflows is not linear, see lines_overflow
+        if self.coords is None:
+            self.lines[ids], self.steps[ids] = tilt_lines(self.lines[ids], self.steps[ids], degrees, self.Z,
+                                                          z_levels, axis)
+        elif isinstance(ids, slice):  # tilted in place
+            planes = self.coords[ids]
+            tilt_planes(planes, degrees, z_levels, axis, out=planes)
+        else:
+            self.coords[ids] = tilt_planes(self.coords[ids], degrees, z_levels, axis)
+
+    def _index(self, ids):
+        """index of some of the planes, a slice if they are contiguous so that they are views on the stack"""
+        if ids is None:
+            return slice(None)
+        ids = np.asarray(ids)
+        if ids.ndim == 1 and ids.size > 0 and np.all(np.diff(ids) == 1):
+            return slice(int(ids[0]), int(ids[-1]) + 1)
+        return ids
+
+    def get_planes(self, ids=None):
+        """
+        generate the coords of some of the planes, planes that are None are made of zeros.
+        order of coordinates in the planes are [0] X, [1] Y, [2] Z
+        Args:
+            ids (numpy array): indices of the planes, all of them if None
+        Returns:
+            (numpy array): (N, 3, Z, W) stack of coordinates
+        """
+        ids = self._index(ids)
+        if self.coords is not None:
+            return self.coords[ids]
+        planes = lines_grid(self.lines[ids], self.steps[ids], self.Z)
+        planes[~self.valid[ids]] = 0
+        return planes
+
+    def __len__(self):
+        return self.N
+
+    def __getitem__(self, i):
+        """
+        Returns:
+            (Plane): plane i, None if the plane has not been set. coords of dense stacks are a view on the stack
+        """
+        if not self.valid[i]:
+            return None
+        plane = Plane(self.Z, self.W)
+        if self.coords is not None:
+            plane.set_plane(self.coords[i])
+        else:
+            plane.line, plane.step = self.lines[i].copy(), self.steps[i].copy()
+        return plane
+
+    def __setitem__(self, i, plane):
+        if plane is None:
+            self.lines[i], self.steps[i], self.valid[i] = 0, 0, False
+            if self.coords is not None:
+                self.coords[i] = 0
+            return
+        if self.coords is None and plane.coords is not None:  # the stack becomes dense
+            self.coords = self.get_planes()
+        if self.coords is not None:
+            self.coords[i] = plane.plane
+        else:
+            self.lines[i], self.steps[i] = plane.line, plane.step
+        self.valid[i] = True
+
+    def __iter__(self):
+        return (self[i] for i in range(self.N))
@@ -2,9 +2,11 @@ from PyQt5 import QtCore
 from pyface.qt import QtGui
 from annotation.components.MayaviViewer import MayaviViewer
 from annotation.components.message.Messenger import Messenger
+import processing
 
 
 class Dialog3DPlot(QtGui.QDialog):
+    MAX_VOXELS = 192 ** 3  # larger volumes are downsampled before the contour extraction
 
     def __init__(self, parent, title="Plot"):
         """
@@ -31,5 +33,19 @@ class Dialog3DPlot(QtGui.QDialog):
         """
         if volume is None or not volume.any():
             return
-        self.messenger.loading_message("Plotting", lambda: self.mayavi.visualization.plot_volume(volume))
+        self.messenger.loading_message("Plotting", lambda: self.mayavi.visualization.plot_volume(self.fit(volume)))
         super().show()
+
+    def fit(self, volume):
+        """
+        Downsamples the volume until it fits MAX_VOXELS
+
+        Args:
+            volume (numpy.ndarray): volume to plot
+
+        Returns:
+            (numpy.ndarray): volume to plot, downsampled if needed
+        """
+        while volume.size > self.MAX_VOXELS:
+            volume = processing.area_downsample(volume)
+        return volume
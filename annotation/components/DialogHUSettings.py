@@ -38,10 +38,16 @@ class DialogHUSettings(QtWidgets.QDialog):
                                                        val=self.cs.max_, default=max_,
                                                        tick_interval=100,
                                                        valueChanged=self.max_slider_changed_handler)
+        self.presets = self.cs.get_presets()
+        self.preset_combo = QtGui.QComboBox()
+        self.preset_combo.addItem("Custom")
+        self.preset_combo.addItems(list(self.presets.keys()))
+        self.preset_combo.activated[str].connect(self.preset_changed_handler)
         self.close_button = QtGui.QPushButton("Close")
         self.close_button.clicked.connect(self.close)
 
         self.layout.addWidget(self.test_image_label)
+        self.layout.addWidget(self.preset_combo)
         self.layout.addWidget(self.min_slider)
         self.layout.addWidget(self.max_slider)
         self.layout.addWidget(self.close_button)
@@ -64,6 +70,16 @@ class DialogHUSettings(QtWidgets.QDialog):
         self.cs.set_max(self.max_slider.value())
         self.update_test_image()
 
+    def preset_changed_handler(self, name):
+        """Moves the sliders to the thresholds of the selected window preset"""
+        if name not in self.presets:
+            return
+        min_, max_ = self.presets[name]
+        # the lower threshold is released first, so that the sliders never clamp each other
+        self.min_slider.setValue(self.min_slider.minimum())
+        self.max_slider.setValue(int(round(max_)))
+        self.min_slider.setValue(int(round(min_)))
+
     def create_test_image(self):
         """Creates a grey-scale test image"""
         return np.tile(np.arange(0, 255).repeat(2), (100, 1)).astype(np.float32) / 255
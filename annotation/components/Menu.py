@@ -25,6 +25,9 @@ class Menu(QtGui.QWidget, metaclass=QObjectSingletonMeta):
     export_gt_volume = QtCore.pyqtSignal()
     apply_delaunay = QtCore.pyqtSignal()
 
+    # options
+    auto_z_roi = QtCore.pyqtSignal(bool)
+
     def __init__(self, window):
         super(Menu, self).__init__(window)
         self.bar = window.menuBar()
@@ -38,6 +41,7 @@ class Menu(QtGui.QWidget, metaclass=QObjectSingletonMeta):
         self.save_action = None
         self.autosave_action = None
         self.load_action = None
+        self.auto_z_roi_action = None
 
         self.add_menu_file()
         self.add_menu_view()
@@ -148,6 +152,11 @@ class Menu(QtGui.QWidget, metaclass=QObjectSingletonMeta):
         HU_settings_action.triggered.connect(self.show_options)
         self.options.addAction(HU_settings_action)
 
+        self.auto_z_roi_action = QtGui.QAction("Crop side volume on canal", self)
+        self.auto_z_roi_action.setCheckable(True)
+        self.auto_z_roi_action.triggered.connect(lambda: self.auto_z_roi.emit(self.auto_z_roi_action.isChecked()))
+        self.options.addAction(self.auto_z_roi_action)
+
     def show_options(self):
         DialogHUSettings().exec_()
 
@@ -1,3 +1,4 @@
+import threading
 from PyQt5 import QtCore, QtWidgets
 from pyface.qt import QtGui
 
@@ -74,13 +75,16 @@ class ProgressIterator(QtWidgets.QWidget):
 class ProgressLoadingDialog(QtWidgets.QDialog):
     progress_s = QtCore.pyqtSignal(int, int)
 
-    def __init__(self, message="Loading", parent=None, cancelable=False):
+    def __init__(self, message="Loading", parent=None, cancelable=False, stops_on_cancel=False):
         """
         Dialog with progress bar
 
         Args:
             message (str): message to show while executing a function
             parent (pyface.qt.QtGui.QWidget): parent widget
+            cancelable (bool): cancel button enabled
+            stops_on_cancel (bool): the function returns early once cancel_event is set, it is waited for instead
+                of terminating its thread, which could leave the locks it holds acquired
         """
         super(ProgressLoadingDialog, self).__init__(parent)
         self.setWindowTitle(message)
@@ -93,7 +97,9 @@ class ProgressLoadingDialog(QtWidgets.QDialog):
         self.progress = self.iterator.progress
         self.layout.addWidget(self.progress)
         self._cancelable = cancelable
+        self._stops_on_cancel = stops_on_cancel
         self.progress_canceled = False
+        self.cancel_event = threading.Event()  # lets pools of workers started by the function stop early
         if self._cancelable:
             self.cancel = QtGui.QPushButton("Cancel")
             self.cancel.clicked.connect(self.kill)
@@ -131,9 +137,14 @@ class ProgressLoadingDialog(QtWidgets.QDialog):
         self.exec_()
 
     def kill(self):
+        self.progress_canceled = True
+        self.cancel_event.set()
+        if self._stops_on_cancel:
+            # the dialog is closed when the function returns
+            self.cancel.setEnabled(False)
+            return
         self.thread.terminate()
         self.close()
-        self.progress_canceled = True
 
 
 def question(parent, title, message, yes=lambda: None, no=lambda: None, default="yes"):
@@ -19,12 +19,20 @@ class Messenger(metaclass=SingletonMeta):
     def loading_message(self, message="", func=lambda: None, parent=None):
         self._strategy.loading_message(message, func, parent)
 
-    def progress_message(self, func, func_args: dict, message="", parent=None, cancelable=False):
+    def progress_message(self, func, func_args: dict, message="", parent=None, cancelable=False,
+                         stops_on_cancel=False):
         """
         Returns:
              (bool): completion of the task
         """
-        return self._strategy.progress_message(func, func_args, message, parent, cancelable)
+        return self._strategy.progress_message(func, func_args, message, parent, cancelable, stops_on_cancel)
+
+    def get_cancel_event(self):
+        """
+        Returns:
+             (threading.Event): event set when the running progress message is canceled
+        """
+        return self._strategy.get_cancel_event()
 
     def question(self, title="", message="", yes=lambda: None,
                  no=lambda: None, default='yes', parent=None):
@@ -1,4 +1,5 @@
 import sys
+import threading
 from abc import ABC, abstractmethod
 
 from annotation.components.message.Dialog import warning, information, LoadingDialog, ProgressLoadingDialog, question
@@ -29,7 +30,8 @@ class MessageStrategy(ABC):
         pass
 
     @abstractmethod
-    def progress_message(self, func, func_args: dict, message="", parent=None, cancelable=False):
+    def progress_message(self, func, func_args: dict, message="", parent=None, cancelable=False,
+                         stops_on_cancel=False):
         """
         Shows a progress loading message
 
@@ -38,12 +40,25 @@ class MessageStrategy(ABC):
             func: function that is executed in background
             func_args (dict): dictionary of arguments for func
             cancelable (bool): cancel button enabled
+            stops_on_cancel (bool): func checks the cancel event (see get_cancel_event) and returns early once it is
+                set, so it is waited for instead of being terminated
 
         Returns:
             (bool): completion of the task
         """
         pass
 
+    @abstractmethod
+    def get_cancel_event(self):
+        """
+        Event of the running progress message, set when the user cancels it.
+        Functions running on a pool of workers check it to stop early.
+
+        Returns:
+            (threading.Event): cancel event
+        """
+        pass
+
     @abstractmethod
     def question(self, title="", message="", yes=lambda: None, no=lambda: None, default='yes', parent=None):
         """
@@ -60,6 +75,8 @@ class MessageStrategy(ABC):
 
 
 class QtMessageStrategy(MessageStrategy):
+    _cancel_event = None  # cancel event of the last progress dialog
+
     def message(self, kind: str, title="", message="", parent=None):
         if kind == "warning":
             warning(parent, title, message)
@@ -69,12 +86,17 @@ class QtMessageStrategy(MessageStrategy):
     def loading_message(self, message="", func=lambda: None, parent=None):
         LoadingDialog(func, message, parent)
 
-    def progress_message(self, func, func_args: dict, message="", parent=None, cancelable=False):
-        pld = ProgressLoadingDialog(message, cancelable=cancelable)
+    def progress_message(self, func, func_args: dict, message="", parent=None, cancelable=False,
+                         stops_on_cancel=False):
+        pld = ProgressLoadingDialog(message, cancelable=cancelable, stops_on_cancel=stops_on_cancel)
+        self._cancel_event = pld.cancel_event
         pld.set_function(lambda: func(step_fn=pld.get_signal(), **func_args))
         pld.start()
         return not pld.progress_canceled
 
+    def get_cancel_event(self):
+        return self._cancel_event if self._cancel_event is not None else threading.Event()
+
     def question(self, title="", message="", yes=lambda: None, no=lambda: None, default='yes', parent=None):
         question(parent, title, message, yes, no, default)
 
@@ -88,7 +110,8 @@ class TerminalMessageStrategy(MessageStrategy):
         func()
         print("Done!")
 
-    def progress_message(self, func, func_args: dict, message="", parent=None, cancelable=False):
+    def progress_message(self, func, func_args: dict, message="", parent=None, cancelable=False,
+                         stops_on_cancel=False):
         def print_bar(val, max):
             print("{}: {}/{} - {}%".format(message, val, max, int(val / max * 100)), end="\r")
 
@@ -96,6 +119,9 @@ class TerminalMessageStrategy(MessageStrategy):
         print("{}: Done!".format(message))
         return True
 
+    def get_cancel_event(self):
+        return threading.Event()  # the terminal cannot cancel
+
     def question(self, title="", message="", yes=lambda: None, no=lambda: None, default='yes', parent=None):
         valid_yes = ['yes', 'y', 'ye']
         valid_no = ['no', 'n']
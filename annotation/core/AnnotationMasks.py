@@ -39,8 +39,38 @@ class AnnotationMasks():
         self.mask_volume = None
         self._edited = False
         self.skip = 0
+        self.z_offset = self.get_side_volume_z_offset()  # first slice of the side volume the masks are drawn on
         self.messenger = Messenger()
 
+    def get_side_volume_z_offset(self):
+        """
+        Returns:
+            (int): first slice of the volume cut by the current side volume
+        """
+        side_volume = self.arch_handler.side_volume
+        return side_volume.z_range[0] if side_volume is not None else 0
+
+    def set_z_offset(self, z_offset):
+        """
+        Moves the annotation splines on a side volume that starts from another slice of the volume,
+        so that they keep their position in the volume.
+
+        Args:
+            z_offset (int): first slice of the new side volume
+        """
+        dy = (self.z_offset - z_offset) * self.arch_handler.side_volume_scale
+        self.z_offset = z_offset
+        if dy == 0:
+            return
+        for i, spline in enumerate(self.masks):
+            if spline is None:
+                continue
+            data = spline.get_json()
+            for cp in data['cp']:
+                cp['y'] += dy
+            self.masks[i] = ClosedSpline(load_from=data)
+            self._edited = True
+
     def check_shape(self, new_shape):
         """
         Check if the given shape is the same as the one loaded from file.
@@ -117,6 +147,9 @@ class AnnotationMasks():
         Returns:
             (bool): computation completed
         """
+        # images of a lazy side volume are all computed here, not one at a time by the worker
+        if not self.arch_handler.side_volume.materialize():
+            return False
         return self.messenger.progress_message(message="Computing 3D canal", func=self._compute_mask_volume,
                                                func_args={}, cancelable=False)
 
@@ -218,6 +251,7 @@ class AnnotationMasks():
             'w': self.w,
             'scaling': self.arch_handler.side_volume_scale,
             'skip': self.skip,
+            'z_offset': self.z_offset,
             'masks': [mask.get_json() if mask is not None else None for mask in self.masks],
             'from_snake': [fs for fs in self.created_from_snake]
         }
@@ -246,6 +280,7 @@ class AnnotationMasks():
         self.w = data['w']
         self.scaling = data['scaling']
         self.skip = data['skip'] if 'skip' in data.keys() else 0
+        self.z_offset = data['z_offset'] if 'z_offset' in data.keys() else 0
         self.masks = [None] * self.n
         self.created_from_snake = [False] * self.n
         for i, spline_dump in enumerate(data['masks']):
@@ -256,8 +291,9 @@ class AnnotationMasks():
             from_snake = data['from_snake'][i] if 'from_snake' in data.keys() else False
             self.set_mask_spline(i, spline, from_snake)
         self.handle_scaling_mismatch()
-        check_shape and self.check_shape(self.arch_handler.side_volume.get().shape)
+        check_shape and self.check_shape(self.arch_handler.side_volume.get_shape())
         self._edited = False
+        self.set_z_offset(self.get_side_volume_z_offset())
 
     def handle_scaling_mismatch(self):
         """
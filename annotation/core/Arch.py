@@ -2,19 +2,21 @@ from annotation.utils.math import get_poly_approx, apply_offset_to_arch
 
 
 class Arch():
-    def __init__(self, arch_handler, arch):
+    def __init__(self, arch_handler, arch, panorex=None):
         """
         Arch not handled as a Spline, but as a list of points.
 
-        We can automatically extract its panorex in every moment.
+        We can automatically extract its panorex in every moment: it is computed on first request,
+        or together with the panorexes of other arches by compute_panorexes.
 
         Args:
             arch_handler (ArchHandler): ArchHandler parent object
             arch (list of (float, float)): list of coordinates
+            panorex (numpy.ndarray): panorex of the arch, if already computed
         """
         self.arch_handler = arch_handler
         self.set_arch(arch)
-        self.set_panorex(self.compute_panorex())
+        self.set_panorex(panorex)
 
     def compute_panorex(self):
         """
@@ -25,6 +27,21 @@ class Arch():
         """
         return self.arch_handler.create_panorex(self.arch)
 
+    @staticmethod
+    def compute_panorexes(arches):
+        """
+        Computes the missing panorexes of several arches with a single batched cut.
+
+        Args:
+            arches (list of Arch): arches of the same ArchHandler
+        """
+        missing = list({id(arch): arch for arch in arches if arch.panorex is None}.values())
+        if not missing:
+            return
+        panorexes = missing[0].arch_handler.create_panorexes([arch.arch for arch in missing])
+        for arch, panorex in zip(missing, panorexes):
+            arch.set_panorex(panorex)
+
     def compute_poly(self):
         """
         Computes the polinomial approximation of the internal attribute arch.
@@ -38,14 +55,14 @@ class Arch():
 
     def update(self, arch=None):
         """
-        Updates the arch with a new set of points, then recomputes panorex.
+        Updates the arch with a new set of points, its panorex will be recomputed.
 
         Args:
             arch (list of (float, float)): new list of coordinates
         """
         if arch is not None:
             self.set_arch(arch)
-        self.set_panorex(self.compute_panorex())
+        self.set_panorex(None)
 
     def get_offsetted(self, amount):
         """
@@ -79,7 +96,7 @@ class Arch():
             (Arch): copy of this Arch
         """
         arch = self.arch.copy()
-        return Arch(self.arch_handler, arch)
+        return Arch(self.arch_handler, arch, self.panorex)
 
     ###########
     # GETTERS #
@@ -89,7 +106,9 @@ class Arch():
         return self.arch
 
     def get_panorex(self):
-        """Returns panorex"""
+        """Returns panorex, computing it if needed"""
+        if self.panorex is None:
+            self.set_panorex(self.compute_panorex())
         return self.panorex
 
     def get_poly(self):
@@ -101,9 +120,10 @@ class Arch():
     ###########
 
     def set_arch(self, arch):
-        """Sets new arch"""
+        """Sets new arch, its panorex is stale"""
         self.arch = arch
         self.poly = self.compute_poly()
+        self.panorex = None
 
     def set_panorex(self, panorex):
         """Sets new panorex"""
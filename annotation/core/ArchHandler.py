@@ -4,6 +4,7 @@ import cv2
 import numpy as np
 import json
 
+import kernels
 import processing
 import viewer
 from Jaw import Jaw
@@ -14,10 +15,10 @@ from annotation.components.message.Strategies import QtMessageStrategy
 from annotation.core.AnnotationMasks import AnnotationMasks
 from annotation.core.Arch import Arch
 from annotation.core.ArchDetections import ArchDetections
-from annotation.core.SideVolume import SideVolume, TiltedSideVolume
+from annotation.core.SideVolume import SideVolume, TiltedSideVolume, LazySideVolume
 from annotation.spline.Spline import Spline
 from annotation.utils.image import get_coords_by_label_3D, get_mask_by_label, filter_volume_Z_axis, plot
-from annotation.utils.math import clip_range, get_poly_approx_
+from annotation.utils.math import get_poly_approx_
 from annotation.utils.metaclasses import SingletonMeta
 from conf import labels as l
 
@@ -30,8 +31,9 @@ class ArchHandler(Jaw, metaclass=SingletonMeta):
     EXPORT_VOLUME_FILENAME = 'volume.npy'
 
     SIDE_VOLUME_SCALE = 4  # desired scale of side_volume
+    Z_ROI_MARGIN = 10  # slices kept above and below the canal by the automatic Z region of interest
 
-    def __init__(self, dicomdir_path):
+    def __init__(self, dicomdir_path, lazy_side_volume=False, **jaw_kwargs):
         """
         Class that handles the arch and panorex computing on top of the Jaw class.
 
@@ -54,13 +56,22 @@ class ArchHandler(Jaw, metaclass=SingletonMeta):
             - canal (numpy.ndarray): same as side_volume, but has just the canal (obtained from masks) and it is scaled to original volume dimensions
             - gt_delaunay (numpy.ndarray): same as gt_volume, the canal has been smoothed with Delaunay algorithm
             - gt_extracted (bool): flags the user has extracted the views from previous annotations
+            - auto_z_roi (bool): crops side_volume on the Z region of interest of the canal (see compute_z_roi)
+            - lazy_side_volume (bool): computes the images of side_volume when they are shown (see LazySideVolume)
 
         Args:
             dicomdir_path (str): path of the DICOMDIR file
+            lazy_side_volume (bool): computes the images of side_volume when they are shown (see LazySideVolume)
+            jaw_kwargs: optional loading arguments forwarded to Jaw (e.g. loader_workers, loader_executor)
         """
         sup = super()
+        # a session can last hours: only DICOM headers are retained, pixel data is read again while exporting
+        jaw_kwargs.setdefault('keep_pixel_data', False)
         self.messenger = Messenger(QtMessageStrategy())
-        self.messenger.loading_message(func=lambda: sup.__init__(dicomdir_path), message="Loading DICOM")
+        self.messenger.progress_message(message="Loading DICOM",
+                                        func=lambda step_fn: sup.__init__(dicomdir_path, step_fn=step_fn,
+                                                                          **jaw_kwargs),
+                                        func_args={}, cancelable=False)
         self.dicomdir_path = dicomdir_path
         self.history = History(self, save_func=self.save_state)
         self.selected_slice = None
@@ -79,6 +90,8 @@ class ArchHandler(Jaw, metaclass=SingletonMeta):
         self.canal = None
         self.gt_delaunay = np.zeros_like(self.gt_volume)
         self.gt_extracted = False
+        self.auto_z_roi = False
+        self.lazy_side_volume = lazy_side_volume
 
     ####################
     # ATTRIBUTE UPDATE #
@@ -112,6 +125,7 @@ class ArchHandler(Jaw, metaclass=SingletonMeta):
         h_arch = self.arch.get_offsetted(-1)
         l_arch = self.arch.get_offsetted(1)
         self.LH_pano_arches = (l_arch, h_arch)
+        Arch.compute_panorexes([self.arch, l_arch, h_arch])
 
     def compute_initial_state(self, selected_slice=0, data=None, want_side_volume=True):
         """
@@ -157,6 +171,7 @@ class ArchHandler(Jaw, metaclass=SingletonMeta):
         if pano_offset == 0:
             h_arch = l_arch = self.arch.copy()
         self.LH_pano_arches = (l_arch, h_arch)
+        Arch.compute_panorexes([self.arch, l_arch, h_arch])
 
     def tilted(self):
         """
@@ -177,18 +192,23 @@ class ArchHandler(Jaw, metaclass=SingletonMeta):
             scale (float): scale of side volume w.r.t. volume dimensions
             tilted (bool): selects TiltedSideVolume instead of default SideVolume
         """
+        self.auto_z_roi and self.set_z_roi(self.compute_z_roi())
+
         # check if needed to recompute side_volume
         if self.old_side_coords is not None \
                 and np.array_equal(self.side_coords, self.old_side_coords) \
                 and self.tilted() == tilted \
                 and self.side_volume is not None \
-                and self.side_volume.correct:
+                and self.side_volume.correct \
+                and self.side_volume.z_range == self.get_z_range():
             return
 
         self.side_volume_scale = self.SIDE_VOLUME_SCALE if scale is None else scale
 
         if tilted:
             self.side_volume = TiltedSideVolume(self, self.side_volume_scale)
+        elif self.lazy_side_volume:
+            self.side_volume = LazySideVolume(self, self.side_volume_scale)
         else:
             self.side_volume = SideVolume(self, self.side_volume_scale)
 
@@ -198,11 +218,32 @@ class ArchHandler(Jaw, metaclass=SingletonMeta):
 
         self.old_side_coords = self.side_coords
 
-        shape = self.side_volume.get().shape
+        shape = self.side_volume.get_shape()
         if self.annotation_masks is None:
             self.annotation_masks = AnnotationMasks(shape, self)
         else:
             self.annotation_masks.check_shape(shape)
+            self.annotation_masks.set_z_offset(self.side_volume.z_range[0])
+
+    def compute_z_roi(self, margin=Z_ROI_MARGIN):
+        """
+        Z region of interest of the canal: the slices spanned by the canal splines drawn on the panorex or,
+        if there are none, by the annotations in gt_volume.
+
+        Args:
+            margin (int): slices kept above and below the canal
+
+        Returns:
+            ((int, int)): first and last (excluded) slice, None if there is no canal to look at
+        """
+        zs = [z for spline in (self.L_canal_spline, self.R_canal_spline) if spline is not None
+              for _, z in spline.get_spline()]
+        if not zs and self.gt_volume is not None:
+            gt = self.get_gt_volume(labels=[l.CONTOUR, l.INSIDE])
+            zs = np.flatnonzero(gt.any(axis=(1, 2)))
+        if len(zs) == 0:
+            return None
+        return max(0, int(np.floor(min(zs))) - margin), min(self.Z, int(np.ceil(max(zs))) + 1 + margin)
 
     ###########################
     # VOLUME + ANNOTATION OPS #
@@ -226,54 +267,20 @@ class ArchHandler(Jaw, metaclass=SingletonMeta):
         i.e. a curved 3D tube that follows the arch
         """
 
-        def assign_to_gt_volume(self, val, x, y, z):
-            x_ = clip_range(x, 0, self.W - 1)
-            y_ = clip_range(y, 0, self.H - 1)
-            z_ = clip_range(z, 0, self.Z - 1)
-            gt_volume[floor(z_), floor(y_), floor(x_)] = val
-            gt_volume[floor(z_), floor(y_), ceil(x_)] = val
-            gt_volume[floor(z_), ceil(y_), floor(x_)] = val
-            gt_volume[floor(z_), ceil(y_), ceil(x_)] = val
-            gt_volume[ceil(z_), floor(y_), floor(x_)] = val
-            gt_volume[ceil(z_), floor(y_), ceil(x_)] = val
-            gt_volume[ceil(z_), ceil(y_), floor(x_)] = val
-            gt_volume[ceil(z_), ceil(y_), ceil(x_)] = val
-
-        from math import floor, ceil
-        gt_volume = np.full_like(self.volume, l.UNLABELED, dtype=np.uint8)
-        if not self.tilted():
-            for z_id, points in enumerate(self.side_coords):
-                step_fn is not None and step_fn(z_id, len(self.side_coords))
-                for w_id, (x, y) in enumerate(points):
-                    if 0 <= int(x) < self.W and 0 <= int(y) < self.H:
-
-                        ### less precise method
-                        # gt_volume[:, int(y), int(x)] = self.canal[z_id, :, w_id]
-
-                        # # floor and ceil only CONTOUR and INSIDE labels
-                        # z_column = self.canal[z_id, :, w_id]
-                        # gt_volume[:, int(y), int(x)] = z_column
-                        # for h_id in np.argwhere(np.logical_or(z_column == l.CONTOUR, z_column == l.INSIDE)):
-                        #     val = z_column[h_id]
-                        #     gt_volume[h_id, floor(y), floor(x)] = val
-                        #     gt_volume[h_id, floor(y), ceil(x)] = val
-                        #     gt_volume[h_id, ceil(y), floor(x)] = val
-                        #     gt_volume[h_id, ceil(y), ceil(x)] = val
-
-                        z_column = self.canal[z_id, :, w_id]
-
-                        # floor and ceil for every label
-                        x_ = clip_range(x, 0, self.W - 1)
-                        y_ = clip_range(y, 0, self.H - 1)
-                        gt_volume[:, floor(y_), floor(x_)] = self.canal[z_id, :, w_id]
-                        gt_volume[:, floor(y_), ceil(x_)] = self.canal[z_id, :, w_id]
-                        gt_volume[:, ceil(y_), floor(x_)] = self.canal[z_id, :, w_id]
-                        gt_volume[:, ceil(y_), ceil(x_)] = self.canal[z_id, :, w_id]
-                        for h_id in np.argwhere(z_column == l.INSIDE):
-                            assign_to_gt_volume(self, l.INSIDE, x, y, h_id)
-                        for h_id in np.argwhere(z_column == l.CONTOUR):
-                            assign_to_gt_volume(self, l.CONTOUR, x, y, h_id)
+        # the images of side_volume start from the first slice of its Z range
+        z0 = self.side_volume.z_range[0]
 
+        if self.z_contiguous:
+            # (Z, H, W) view of a (H, W, Z) buffer, the Z columns written below are contiguous
+            gt_volume = np.moveaxis(np.full((self.H, self.W, self.Z), l.UNLABELED, dtype=np.uint8), -1, 0)
+        else:
+            gt_volume = np.full_like(self.volume, l.UNLABELED, dtype=np.uint8)
+        if not self.tilted():
+            # each canal column is written on the four columns around its point, floor and ceil for every label
+            step_fn is not None and step_fn(0, len(self.side_coords))
+            points = np.asarray(self.side_coords, np.float64).reshape(-1, 2)
+            columns = np.moveaxis(self.canal, 1, 0).reshape(self.canal.shape[1], -1)  # (h, N * W)
+            kernels.scatter_columns(gt_volume, points, columns, z0)
         else:
             for i, (img, plane) in enumerate(zip(self.canal, self.side_volume.planes)):
                 step_fn is not None and step_fn(i, len(self.side_coords))
@@ -281,12 +288,11 @@ class ArchHandler(Jaw, metaclass=SingletonMeta):
                     continue
                 if np.array_equal(img, np.full_like(img, l.UNLABELED, dtype=np.uint8)):
                     continue
-                X, Y, Z = plane.plane
-                for val, x, y, z in np.nditer([img, X, Y, Z]):
-                    assign_to_gt_volume(self, val, x, y, z)
-                    # gt_volume[z, y, x] = val
+                # each label is written on the eight voxels around its position
+                X, Y, Z = plane.plane[:, z0:z0 + img.shape[0]]
+                kernels.scatter_voxels(gt_volume, img, X, Y, Z)
 
-        self.set_gt_volume(gt_volume)
+        self.set_gt_volume(np.ascontiguousarray(gt_volume))
 
     def compute_gt_volume(self):
         """
@@ -295,6 +301,8 @@ class ArchHandler(Jaw, metaclass=SingletonMeta):
         Returns:
             (bool): completion of the task
         """
+        if not self.side_volume.materialize():
+            return False
         return self.messenger.progress_message(message="Computing ground truth volume",
                                                func=self._compute_gt_volume,
                                                func_args={}, cancelable=True)
@@ -493,6 +501,7 @@ class ArchHandler(Jaw, metaclass=SingletonMeta):
             ((numpy.ndarray, numpy.ndarray)): panorexes
         """
         l_arch, h_arch = self.LH_pano_arches
+        Arch.compute_panorexes([l_arch, h_arch])
         return (l_arch.get_panorex(), h_arch.get_panorex())
 
     def get_jaw_with_gt(self):
@@ -1,8 +1,12 @@
-from Plane import Plane
+from Plane import PlaneStack
+from resampling import chunk_size, run_chunks, MEMORY_BUDGET
 import numpy as np
 import cv2
 import os
 import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from annotation.components.message.Messenger import Messenger
 
@@ -12,6 +16,9 @@ class SideVolume():
     SIDE_COORDS_FILENAME = "side_coords.npy"
     COORDS_FILENAME = "coords.npy"
     PLANES_FILENAME = "planes.npy"
+    Z_RANGE_FILENAME = "z_range.npy"
+    PLAN_FILENAME = "plan_{}.npz"
+    PLAN_METHODS = ['bilinear', 'nearest']  # resampling plans of side_coords, for the volume and for the gt volume
     SAVE_DIRNAME = "d_side_volume"
 
     def __init__(self, arch_handler, scale):
@@ -28,7 +35,8 @@ class SideVolume():
         self.original = None
         self.data = None
         self.correct = True
-        self.planes = [None] * len(arch_handler.side_coords)
+        self.planes = self._empty_planes()
+        self.z_range = arch_handler.get_z_range()  # slices of the volume cut by the images
         self.update()
 
     def is_there_data_to_load(self):
@@ -40,18 +48,19 @@ class SideVolume():
         co = os.path.join(dir, self.COORDS_FILENAME)
         return os.path.isfile(sv) and os.path.isfile(sc) and os.path.isfile(co)
 
+    def _empty_planes(self):
+        """Stack of the planes of side_coords, none of them computed yet"""
+        side_coords = np.asarray(self.arch_handler.side_coords)
+        w = side_coords.shape[1] if side_coords.ndim == 3 else 0
+        return PlaneStack(len(side_coords), self.arch_handler.Z, w)
+
     def _save_planes(self):
         base = os.path.dirname(self.arch_handler.dicomdir_path)
         dir = os.path.join(base, self.SAVE_DIRNAME)
         p = os.path.join(dir, self.PLANES_FILENAME)
-        n, h, w = self.original.shape
-        empty = np.zeros((3, h, w), dtype=np.float64)
-        planes = np.repeat(empty[np.newaxis, :, :, :], n, axis=0)
-        for i, plane in enumerate(self.planes):
-            if plane is None:
-                continue
-            planes[i] = plane.plane
-        np.save(p, planes)
+        # planes keep all the slices, the images only the ones of z_range. planes that are None are saved as zeros.
+        # lines and steps of the planes are saved, their coords are generated when the cuts are computed
+        np.save(p, self.planes.to_array())
 
     def _load_planes(self):
         base = os.path.dirname(self.arch_handler.dicomdir_path)
@@ -61,16 +70,24 @@ class SideVolume():
             msg = "Could not load tilted side volume: {} is missing".format(self.PLANES_FILENAME)
             print(msg)
             raise FileNotFoundError(msg)
-        planes = np.load(p)
-        n, _, h, w = planes.shape
-        self.planes = []
-        for plane in planes:
-            if not plane.any():
-                self.planes.append(None)
-                continue
-            plane_obj = Plane(h, w)
-            plane_obj.plane = plane
-            self.planes.append(plane_obj)
+        # older saves hold the dense coords of the planes, they are converted to lines and steps
+        self.planes = PlaneStack.from_array(np.load(p, mmap_mode='r'), self.arch_handler.Z)
+
+    def _save_plans(self):
+        """Saves the resampling plans of side_coords, so that they are not built again"""
+        base = os.path.dirname(self.arch_handler.dicomdir_path)
+        dir = os.path.join(base, self.SAVE_DIRNAME)
+        for method in self.PLAN_METHODS:
+            p = os.path.join(dir, self.PLAN_FILENAME.format(method))
+            self.arch_handler.save_resampling_plan(p, 'lines', self.arch_handler.side_coords, method)
+
+    def _load_plans(self):
+        """Loads the resampling plans of side_coords, missing or stale plans are just built again when needed"""
+        base = os.path.dirname(self.arch_handler.dicomdir_path)
+        dir = os.path.join(base, self.SAVE_DIRNAME)
+        for method in self.PLAN_METHODS:
+            p = os.path.join(dir, self.PLAN_FILENAME.format(method))
+            self.arch_handler.load_resampling_plan(p, 'lines', self.arch_handler.side_coords, method)
 
     def save_(self):
         """Saves important data"""
@@ -81,7 +98,9 @@ class SideVolume():
         np.save(os.path.join(dir, self.SIDE_VOLUME_FILENAME), self.original)
         np.save(os.path.join(dir, self.SIDE_COORDS_FILENAME), self.arch_handler.side_coords)
         np.save(os.path.join(dir, self.COORDS_FILENAME), np.asarray(self.arch_handler.coords))
+        np.save(os.path.join(dir, self.Z_RANGE_FILENAME), np.asarray(self.z_range))
         self._save_planes()
+        self._save_plans()
 
     def load_(self):
         """Loads data and checks for consistency"""
@@ -99,14 +118,23 @@ class SideVolume():
         sv_ = np.load(sv)
         sc_ = np.load(sc)
         co_ = np.load(co, allow_pickle=True)
+        zr = os.path.join(dir, self.Z_RANGE_FILENAME)
+        # side volumes saved before the Z region of interest have all the slices
+        z_range = tuple(int(z) for z in np.load(zr)) if os.path.isfile(zr) else (0, self.arch_handler.Z)
+        if sv_.shape[1] != z_range[1] - z_range[0]:
+            msg = "Loaded side volume does not match with its Z range"
+            print(msg)
+            raise ValueError(msg)
 
         if not np.array_equal(sc_, self.arch_handler.side_coords):
             msg = "Loaded side coords do not match with current side coords"
             print(msg)
             raise ValueError(msg)
         self.data = sv_
+        self.z_range = z_range
         self.arch_handler.side_coords = sc_
         self.arch_handler.coords = (co_[0], co_[1], co_[2], co_[3])
+        self._load_plans()
         self._postprocess_data()
 
     def _postprocess_data(self):
@@ -117,30 +145,42 @@ class SideVolume():
         """
         # rescaling the projection volume properly
         self.original = self.data
-        width = int(self.data.shape[2] * self.scale)
-        height = int(self.data.shape[1] * self.scale)
-        scaled_side_volume = np.ndarray(shape=(self.data.shape[0], height, width))
-
-        for i in range(self.data.shape[0]):
-            scaled_side_volume[i] = cv2.resize(self.data[i, :, :], (width, height), interpolation=cv2.INTER_AREA)
+        scaled_side_volume = self._rescale(self.data)
 
         # padding the side volume and rescaling
         scaled_side_volume = cv2.normalize(scaled_side_volume, scaled_side_volume, 0, 1, cv2.NORM_MINMAX)
         self.original = cv2.normalize(self.original, self.original, 0, 1, cv2.NORM_MINMAX)
         self.data = scaled_side_volume
 
+    def _rescale(self, images):
+        """
+        Args:
+            images (numpy.ndarray): images of side volume with the original shape
+
+        Returns:
+            (numpy.ndarray): images resized by scale
+        """
+        width = int(images.shape[2] * self.scale)
+        height = int(images.shape[1] * self.scale)
+        scaled_side_volume = np.ndarray(shape=(images.shape[0], height, width))
+
+        for i in range(images.shape[0]):
+            scaled_side_volume[i] = cv2.resize(images[i, :, :], (width, height), interpolation=cv2.INTER_AREA)
+        return scaled_side_volume
+
     def __update(self, step_fn=None):
         """
-        Computes and updates the side volume.
+        Computes and updates the side volume. If the cuts are canceled data is left None.
 
         Args:
             scale (float): scale of side volume w.r.t. volume dimensions
         """
-        self.data = self.arch_handler.line_slice(self.arch_handler.side_coords, step_fn=step_fn)
-        self.planes = [None] * len(self.arch_handler.side_coords)
-        for i, side_coord in enumerate(self.arch_handler.side_coords):
-            self.planes[i] = Plane(self.arch_handler.Z, len(side_coord))
-            self.planes[i].from_line(side_coord)
+        self.z_range = self.arch_handler.get_z_range()
+        self.data = self.arch_handler.line_slice(self.arch_handler.side_coords, step_fn=step_fn,
+                                                 cancel_event=self.messenger.get_cancel_event(), z_range=self.z_range)
+        if self.data is None:
+            return
+        self.planes = PlaneStack.from_lines(self.arch_handler.side_coords, self.arch_handler.Z)
         self._postprocess_data()
 
     def update(self):
@@ -148,7 +188,10 @@ class SideVolume():
         self.correct = self.messenger.progress_message(message="Computing side volume",
                                                        func=self.__update,
                                                        func_args={},
-                                                       cancelable=False)
+                                                       cancelable=True,
+                                                       stops_on_cancel=True) and self.data is not None
+        if not self.correct:
+            return
         self.messenger.loading_message("Saving views", self.save_)
 
     def get_slice(self, pos):
@@ -174,6 +217,178 @@ class SideVolume():
         """
         return self.data
 
+    def get_shape(self):
+        """
+        Returns shape of side volume
+
+        Returns:
+            ((int, int, int)): amount of images, height and width of the images
+        """
+        return self.data.shape
+
+    def materialize(self):
+        """
+        Computes all the images of side volume, before reading original or data as a whole.
+        Images of SideVolume are computed up front.
+
+        Returns:
+            (bool): side volume is computed
+        """
+        return self.correct
+
+
+class LazySideVolume(SideVolume):
+    CACHE_SIZE = 64  # images kept in memory until the side volume is materialized
+    PREFETCH = 4  # images computed in background after the requested one, in the direction of the slider
+    PREFETCHER = ThreadPoolExecutor(max_workers=1)  # background thread shared by all the lazy side volumes
+
+    def __init__(self, arch_handler, scale):
+        """
+        Class that manages a side volume whose images are computed the first time they are requested.
+        Images are kept in a LRU cache and the next ones in the direction of the slider are computed on
+        a background thread. Consumers of the whole side volume call materialize first.
+
+        Images are normalized on the bounds of the volume, known without cutting it (see Jaw.get_min_max),
+        instead of the range of all the images as SideVolume does. Nothing is saved until the side volume
+        is materialized, the views saved before are left as they are.
+
+        Args:
+            arch_handler (annotation.core.ArchHandler.ArchHandler): arch handler that is parent of this object
+            scale (float): scale of the desired side_volume wrt the orginal shape
+        """
+        self.cache = OrderedDict()
+        self.pending = {}  # futures of the images being computed in background
+        self.cache_lock = threading.Lock()
+        self.lines = None  # xy coords of the images, side_coords when the side volume was updated
+        self.norm = None  # scale and shift normalizing the images on the bounds of the volume
+        self.last_pos = None
+        super().__init__(arch_handler, scale)
+
+    def update(self):
+        """Resets the side volume on the current side_coords, images are computed when requested."""
+        with self.cache_lock:
+            for future in set(self.pending.values()):
+                future.cancel()
+            # new containers: images still computed in background for the old side_coords are dropped
+            self.cache, self.pending = OrderedDict(), {}
+        self.z_range = self.arch_handler.get_z_range()
+        self.lines = np.array(self.arch_handler.side_coords, np.float64)
+        self.planes = PlaneStack.from_lines(self.lines, self.arch_handler.Z)
+        self.original, self.data = None, None
+        # cuts are clipped in [0, 1] and within the bounds of the volume, points out of the volume are 0
+        low, high = np.clip(self.arch_handler.get_min_max(), 0, 1)
+        scale = 1. / (high - low) if high - low > np.finfo(np.float64).eps else 0.
+        self.norm = scale, -low * scale
+        self.correct = True
+
+    def _normalize(self, images, norm):
+        """
+        Args:
+            images (numpy.ndarray): images to normalize in place
+            norm ((float, float)): scale and shift of the normalization
+
+        Returns:
+            (numpy.ndarray): the images in [0, 1], values below the bounds of the volume are 0
+        """
+        scale, shift = norm
+        images *= scale
+        images += shift
+        return np.clip(images, 0, 1, out=images)
+
+    def _postprocess_data(self):
+        """Rescaling and normalization of all the images, as get_slice does"""
+        self.original = self.data
+        self.data = self._normalize(self._rescale(self.original), self.norm)
+        self.original = self._normalize(self.original, self.norm)
+
+    def materialize(self):
+        """Computes all the images of side volume and saves them, the cache is not needed anymore."""
+        if self.data is None:
+            super().update()
+            with self.cache_lock:
+                self.cache, self.pending = OrderedDict(), {}
+        return self.correct
+
+    def get(self):
+        self.materialize()
+        return self.data
+
+    def get_shape(self):
+        if self.data is not None:
+            return self.data.shape
+        h = self.z_range[1] - self.z_range[0]
+        return len(self.lines), int(h * self.scale), int(self.lines.shape[1] * self.scale)
+
+    def _compute_images(self, lines, z_range, norm):
+        """
+        Args:
+            lines (numpy.ndarray): (N, W, 2) lines of xy coords of the images
+            z_range ((int, int)): slices of the volume cut by the images
+            norm ((float, float)): scale and shift normalizing the images
+
+        Returns:
+            (numpy.ndarray): images of the lines, rescaled and normalized as materialize does
+        """
+        cuts = self.arch_handler.line_slice(lines, z_range=z_range, cache_plan=False)
+        images = self._rescale(cuts.reshape(len(lines), z_range[1] - z_range[0], lines.shape[1]))
+        return self._normalize(images, norm)
+
+    def _cache_image(self, cache, pos, img):
+        """Adds an image to the LRU cache, cache_lock must be held"""
+        cache[pos] = img
+        cache.move_to_end(pos)
+        while len(cache) > self.CACHE_SIZE:
+            cache.popitem(last=False)
+
+    def _prefetch_images(self, ids, lines, z_range, norm, cache, pending):
+        """Computes the images at ids in background, into the cache they were requested for"""
+        try:
+            images = self._compute_images(lines, z_range, norm)
+            with self.cache_lock:
+                for pos, img in zip(ids, images):
+                    self._cache_image(cache, pos, img)
+            return dict(zip(ids, images))
+        finally:
+            with self.cache_lock:
+                for pos in ids:
+                    pending.pop(pos, None)
+
+    def _prefetch(self, pos):
+        """Starts the computation of the next images after pos, in the direction of the last move of the slider"""
+        step = -1 if self.last_pos is not None and pos < self.last_pos else 1
+        self.last_pos = pos
+        n = len(self.lines)
+        with self.cache_lock:
+            ids = [i for i in range(pos + step, pos + step * (self.PREFETCH + 1), step)
+                   if 0 <= i < n and i not in self.cache and i not in self.pending]
+            if not ids:
+                return
+            # the state of the side volume is passed as it is now, it can be updated before the job runs
+            future = self.PREFETCHER.submit(self._prefetch_images, ids, self.lines[ids], self.z_range, self.norm,
+                                            self.cache, self.pending)
+            for i in ids:
+                self.pending[i] = future
+
+    def get_slice(self, pos):
+        if self.data is not None:
+            return self.data[pos]
+        with self.cache_lock:
+            img = self.cache.get(pos)
+            if img is not None:
+                self.cache.move_to_end(pos)
+            future = self.pending.get(pos)
+        if img is None and future is not None:
+            try:
+                img = future.result()[pos]
+            except Exception:  # canceled or failed in background, computed here instead
+                img = None
+        if img is None:
+            img = self._compute_images(self.lines[[pos]], self.z_range, self.norm)[0]
+            with self.cache_lock:
+                self._cache_image(self.cache, pos, img)
+        self._prefetch(pos)
+        return img
+
 
 class TiltedSideVolume(SideVolume):
     CANAL_SPLINES_FILENAME = "canals.json"
@@ -187,7 +402,8 @@ class TiltedSideVolume(SideVolume):
         self.original = None
         self.data = None
         self.correct = True
-        self.planes = [None] * len(arch_handler.side_coords)
+        self.planes = self._empty_planes()
+        self.z_range = arch_handler.get_z_range()
         if self.is_there_data_to_load():
             self.try_load()
         else:
@@ -251,33 +467,44 @@ class TiltedSideVolume(SideVolume):
             return
         p, start, end = spline.get_poly_spline()
         derivative = np.polyder(p, 1)
-        for x in range(self.data.shape[0]):
-            if x in range(int(start), int(end)):
-                step_fn is not None and step_fn(x, self.data.shape[0])
-                side_coord = self.arch_handler.side_coords[x]
-                plane = Plane(self.arch_handler.Z, len(side_coord))
-                plane.from_line(side_coord)
-                angle = -np.degrees(np.arctan(derivative(x)))
-                plane.tilt_z(angle, p(x))
-                cut = self.arch_handler.plane_slice(plane)
-                debug and print("{}/{}".format(x, len(self.planes)), end='\r')
-                self.planes[x] = plane
-                self.data[x] = cut
+        n = self.data.shape[0]
+        xs = range(max(0, int(start)), min(n, int(end)))
+        if len(xs) == 0:
+            return
+
+        side_coords = np.asarray(self.arch_handler.side_coords)
+
+        def compute_cuts(first, last):
+            # the planes of a chunk of cuts are built, tilted and resampled together
+            ids = np.asarray(xs[first:last])
+            self.planes.set_lines(ids, side_coords[ids])
+            angles = -np.degrees(np.arctan(derivative(ids)))
+            self.planes.tilt_z(angles, p(ids), ids)
+            self.data[ids] = self.arch_handler.plane_slice(self.planes.get_planes(ids), z_range=self.z_range)
+            debug and print("{}/{}".format(xs.start + last, len(self.planes)), end='\r')
+
+        # chunks of planes sized on the memory budget, the planes of a chunk are resampled by the workers
+        plane_bytes = 2 * 3 * self.planes.Z * self.planes.W * np.dtype(np.float64).itemsize
+        run_chunks(compute_cuts, len(xs), chunk_size(plane_bytes, MEMORY_BUDGET),
+                   step_fn=step_fn and (lambda done, total: step_fn(xs.start + done, n)),
+                   cancel_event=self.messenger.get_cancel_event())
 
     def update(self):
         n = len(self.arch_handler.side_coords)
-        h = self.arch_handler.Z
+        self.z_range = self.arch_handler.get_z_range()
+        h = self.z_range[1] - self.z_range[0]
         w = max([len(points) for points in self.arch_handler.side_coords])
         self.data = np.zeros((n, h, w))
+        self.planes = self._empty_planes()
         completed = self.messenger.progress_message(func=self._compute_on_spline,
                                                     func_args={'spline': self.arch_handler.L_canal_spline},
                                                     message="Computing tilted views (L)",
-                                                    cancelable=True)
+                                                    cancelable=True, stops_on_cancel=True)
         if completed:
             completed = self.messenger.progress_message(func=self._compute_on_spline,
                                                         func_args={'spline': self.arch_handler.R_canal_spline},
                                                         message="Computing tilted views (R)",
-                                                        cancelable=True)
+                                                        cancelable=True, stops_on_cancel=True)
         if not completed:
             self.correct = False
             return
@@ -32,6 +32,7 @@ class Container(QtGui.QWidget):
         self.mb.save.connect(self.save)
         self.mb.autosave.connect(self.autosave)
         self.mb.load.connect(self.load)
+        self.mb.auto_z_roi.connect(self.auto_z_roi)
 
         self.screen: Screen = None
 
@@ -56,7 +57,8 @@ class Container(QtGui.QWidget):
     def connect_to_menubar(self):
         # view
         self.mb.view_volume.connect(
-            lambda: self.show_Dialog3DPlot(self.arch_handler.volume, "Volume"))
+            lambda: self.show_Dialog3DPlot(self.arch_handler.get_preview_volume(max_voxels=Dialog3DPlot.MAX_VOXELS),
+                                           "Volume"))
 
         self.mb.view_gt_volume.connect(
             # lambda: self.show_Dialog3DPlot(self.arch_handler.gt_volume, "Ground truth"))
@@ -97,6 +99,11 @@ class Container(QtGui.QWidget):
     def autosave(self, autosave):
         self.arch_handler.history.set_autosave(autosave)
 
+    def auto_z_roi(self, auto_z_roi):
+        self.arch_handler.auto_z_roi = auto_z_roi
+        # side_volume goes back to the whole volume the next time it is computed
+        auto_z_roi or self.arch_handler.set_z_roi(None)
+
     def load(self):
         def yes(self):
             self.arch_handler.load_state()
@@ -150,6 +157,7 @@ class Container(QtGui.QWidget):
         else:
             self.arch_handler = ArchHandler(dicomdir_path)
             self.connect_to_menubar()
+        self.auto_z_roi(self.mb.auto_z_roi_action.isChecked())
 
         self.clear()
         self.mb.enable_(self.mb.view)
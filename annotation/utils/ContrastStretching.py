@@ -23,6 +23,13 @@ class ContrastStretching(metaclass=SingletonMeta):
         self.set_min(min_)
         self.set_max(max_)
 
+    def get_presets(self):
+        """
+        Returns:
+            (dict): window presets of the volume, preset name -> (min HU, max HU)
+        """
+        return self.arch_handler.get_window_presets()
+
     def stretch(self, img):
         min_, max_ = 0., 1.
         l_th = self.arch_handler.convert_HU_to_01(self.min_)
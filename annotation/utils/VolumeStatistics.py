@@ -0,0 +1,137 @@
+import numpy as np
+
+CHUNK_SLICES = 32  # amount of slices counted at once while building the histogram
+
+# common (level, width) CT windows, in HU
+WINDOWS = {
+    'Bone': (500, 2000),
+    'Soft tissue': (40, 400),
+}
+
+
+class VolumeStatistics():
+    def __init__(self, volume=None, HU_slope=1, HU_intercept=0, values=None, counts=None):
+        """
+        Histogram of the raw values of a volume.
+
+        The histogram is built once with integer bins, then it answers exact quantiles, minimum, maximum
+        and window presets in O(bins) instead of sorting or scanning the whole volume.
+
+        Args:
+            volume (np.ndarray): raw volume, usually the uint16/int16 data of the DICOM files
+            HU_slope (float): RescaleSlope used to convert raw values to HU
+            HU_intercept (float): RescaleIntercept used to convert raw values to HU
+            values (np.ndarray): distinct raw values, to restore a histogram built before (see get_arrays)
+            counts (np.ndarray): occurrences of each value, to restore a histogram built before
+        """
+        self.HU_slope = HU_slope
+        self.HU_intercept = HU_intercept
+        if volume is not None:
+            values, counts = self.compute_histogram(volume)
+        self.values = np.asarray(values)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.cumulative = np.cumsum(self.counts)
+        self.size = int(self.cumulative[-1])
+
+    @staticmethod
+    def compute_histogram(volume):
+        """
+        Counts the occurrences of each value of the volume, CHUNK_SLICES slices at a time.
+
+        Integer volumes up to 16 bits are counted with np.bincount, other types fall back to np.unique.
+
+        Args:
+            volume (np.ndarray): raw volume
+
+        Returns:
+            (np.ndarray, np.ndarray): sorted distinct values and their occurrences
+        """
+        if volume.dtype.kind not in 'iu' or volume.dtype.itemsize > 2:
+            return np.unique(volume, return_counts=True)
+        info = np.iinfo(volume.dtype)
+        counts = np.zeros(info.max - info.min + 1, dtype=np.int64)
+        for z in range(0, volume.shape[0], CHUNK_SLICES):
+            chunk = volume[z:z + CHUNK_SLICES].ravel().astype(np.int32) - info.min
+            counts += np.bincount(chunk, minlength=counts.size)
+        values = np.flatnonzero(counts)
+        return (values + info.min).astype(volume.dtype), counts[values]
+
+    def get_arrays(self):
+        """
+        Returns:
+            (np.ndarray, np.ndarray): distinct values and their occurrences, to store the histogram
+        """
+        return self.values, self.counts
+
+    def get_order_statistic(self, k):
+        """
+        Value that would be at position k if the volume was sorted
+
+        Args:
+            k (int or np.ndarray): position(s) in the sorted volume
+
+        Returns:
+            (np.ndarray): value(s)
+        """
+        return self.values[np.searchsorted(self.cumulative, k, side='right')]
+
+    def quantile(self, q):
+        """
+        Exact quantile of the volume, same result of np.quantile with the default linear method
+
+        Args:
+            q (float or sequence of float): quantile(s) between 0 and 1
+
+        Returns:
+            (float or np.ndarray): quantile(s)
+        """
+        index = (self.size - 1) * np.asarray(q, dtype=np.float64)
+        lower = np.floor(index).astype(np.int64)
+        upper = np.minimum(lower + 1, self.size - 1)
+        a = self.get_order_statistic(lower).astype(np.float64)
+        b = self.get_order_statistic(upper).astype(np.float64)
+        t = index - lower
+        # same lerp as numpy, to be numerically identical
+        quantile = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+        if self.values.dtype.kind == 'f':  # numpy keeps the precision of float volumes
+            quantile = quantile.astype(self.values.dtype)
+        return quantile[()] if quantile.ndim == 0 else quantile
+
+    def min(self):
+        return self.values[0]
+
+    def max(self):
+        return self.values[-1]
+
+    def to_HU(self, value):
+        """
+        Converts raw value(s) to HU
+
+        Args:
+            value (float or np.ndarray): raw value(s)
+
+        Returns:
+            (float or np.ndarray): HU value(s)
+        """
+        return value * self.HU_slope + self.HU_intercept
+
+    def get_window_presets(self, dicom_window=None):
+        """
+        Window presets in HU, as (min, max) tuples
+
+        Args:
+            dicom_window ((float, float)): optional (center, width) window read from the DICOM files
+
+        Returns:
+            (dict): preset name -> (min HU, max HU)
+        """
+        presets = {
+            'Full range': (float(self.to_HU(self.min())), float(self.to_HU(self.max()))),
+            'Auto (1% - 99%)': tuple(float(v) for v in self.to_HU(self.quantile((0.01, 0.99)))),
+        }
+        if dicom_window is not None:
+            c, w = dicom_window
+            presets['DICOM'] = (c - w / 2, c + w / 2)
+        for name, (c, w) in WINDOWS.items():
+            presets[name] = (c - w / 2, c + w / 2)
+        return presets
@@ -34,8 +34,8 @@ def delete_file(file_path):
 
 
 def export_gt_volume_npy(dicomdir):
-    ah = ArchHandler(dicomdir)
-    ah.__init__(dicomdir)
+    ah = ArchHandler(dicomdir, keep_pixel_data=False)
+    ah.__init__(dicomdir, keep_pixel_data=False)
     if ah.gt_volume.any() == True:
         ah.compute_initial_state(96, want_side_volume=False)
         ah.extract_data_from_gt(load_annotations=True)
@@ -3,9 +3,202 @@ from pydicom.filereader import read_dicomdir
 import re
 import os
 import numpy as np
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
+LOADER_WORKERS = cpu_count()
+LOADER_EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor
+}
 
-def dicom_from_dicomdir(dicom_dir):
+
+def release_pixel_data(dataset, keep_pixel_data=True):
+    """
+    drop the decoded pixel cache of a dataset and, optionally, its raw PixelData bytes.
+    once the image is stored in the volume both of them are just extra copies of the slice
+
+    Args:
+        dataset (pydicom.dataset.FileDataset): dataset to lighten
+        keep_pixel_data (bool): if false the PixelData element is deleted too
+    """
+    dataset._pixel_array = None
+    dataset._pixel_id = {}
+    if not keep_pixel_data and 'PixelData' in dataset:
+        del dataset.PixelData
+
+
+def read_dicom_slice(path, keep_pixel_data=True):
+    """
+    read a single dicom file and decode its pixel data
+
+    Args:
+        path (str): path of the dicom file
+        keep_pixel_data (bool): if false the PixelData of the returned dataset is released
+
+    Returns:
+        (pydicom.dataset.FileDataset, numpy array): dataset and decoded image of the slice
+    """
+    dataset = pydicom.dcmread(path)
+    image = dataset.pixel_array
+    release_pixel_data(dataset, keep_pixel_data)
+    return dataset, image
+
+
+def decode_dicom_slice(path, volume, index, keep_pixel_data=True):
+    """
+    read a single dicom file and decode its pixel data straight into a row of the volume
+
+    Args:
+        path (str): path of the dicom file
+        volume (numpy array): preallocated (Z, H, W) volume
+        index (int): Z index of the slice
+        keep_pixel_data (bool): if false the PixelData of the returned dataset is released
+
+    Returns:
+        (pydicom.dataset.FileDataset): dataset of the slice
+    """
+    dataset, volume[index] = read_dicom_slice(path, keep_pixel_data)
+    return dataset
+
+
+def load_slices(paths, workers=LOADER_WORKERS, executor='thread', keep_pixel_data=True, step_fn=None):
+    """
+    read and decode a list of dicom files on a pool of workers. each decoded image is written
+    straight into a volume which is allocated once from the shape of the first slice, then the pixel
+    cache of its dataset is released so that the volume is the only copy of the images kept in memory.
+
+    Args:
+        paths (list of str): paths of the dicom files, the order is kept in the resulting volume
+        workers (int): amount of workers of the pool, 1 reads the slices sequentially
+        executor (str): kind of pool, one of 'thread' or 'process'
+        keep_pixel_data (bool): if false the raw PixelData of the datasets is released as well
+        step_fn: function to log progress
+
+    Returns:
+        (list of pydicom.dataset.FileDataset, numpy array): datasets and (Z, H, W) volume
+    """
+    if executor not in LOADER_EXECUTORS:
+        raise ValueError("unknown executor {}, use one of {}".format(executor, list(LOADER_EXECUTORS.keys())))
+
+    num_slices = len(paths)
+    datasets = [None] * num_slices
+
+    # the first slice tells us shape and type of the whole volume
+    datasets[0], image = read_dicom_slice(paths[0], keep_pixel_data)
+    volume = np.empty((num_slices,) + image.shape, dtype=image.dtype)
+    volume[0] = image
+    del image
+    step_fn is not None and step_fn(1, num_slices)
+
+    if workers is None or workers < 2:
+        for i in range(1, num_slices):
+            datasets[i] = decode_dicom_slice(paths[i], volume, i, keep_pixel_data)
+            step_fn is not None and step_fn(i + 1, num_slices)
+        return datasets, volume
+
+    with LOADER_EXECUTORS[executor](max_workers=workers) as pool:
+        if executor == 'thread':
+            # threads share the volume, each of them fills its own row
+            futures = {pool.submit(decode_dicom_slice, paths[i], volume, i, keep_pixel_data): i
+                       for i in range(1, num_slices)}
+        else:
+            futures = {pool.submit(read_dicom_slice, paths[i], keep_pixel_data): i for i in range(1, num_slices)}
+        for done, future in enumerate(as_completed(futures), 2):
+            i = futures.pop(future)
+            if executor == 'thread':
+                datasets[i] = future.result()
+            else:
+                datasets[i], volume[i] = future.result()
+            step_fn is not None and step_fn(done, num_slices)
+    return datasets, volume
+
+
+def read_dicom_headers(paths, workers=LOADER_WORKERS, step_fn=None):
+    """
+    read the headers of a list of dicom files, stopping before their pixel data
+
+    Args:
+        paths (list of str): paths of the dicom files
+        workers (int): amount of threads used to read the files
+        step_fn: function to log progress
+
+    Returns:
+        (list of pydicom.dataset.FileDataset): header-only datasets, in the same order of paths
+    """
+    num_slices = len(paths)
+    datasets = [None] * num_slices
+    with ThreadPoolExecutor(max_workers=max(1, workers or 1)) as pool:
+        futures = {pool.submit(pydicom.dcmread, path, stop_before_pixels=True): i for i, path in enumerate(paths)}
+        for done, future in enumerate(as_completed(futures), 1):
+            datasets[futures.pop(future)] = future.result()
+            step_fn is not None and step_fn(done, num_slices)
+    return datasets
+
+
+def read_overlays(datasets, group):
+    """
+    decode the overlay plane of a whole series at once: the OverlayData bytes of every slice are gathered
+    into a single buffer and unpacked with one np.unpackbits call
+
+    Args:
+        datasets (list of pydicom.dataset.FileDataset): datasets of the series, headers are enough
+        group (int): group of the overlay, e.g. 0x6004
+
+    Returns:
+        (numpy array): uint8 (Z, OverlayRows, OverlayColumns) binary volume
+
+    Raises:
+        AttributeError: if a slice has no overlay in the group
+        ValueError: if the overlays of the slices have different shapes or not enough data
+    """
+    rows, columns = datasets[0][group, 0x0010].value, datasets[0][group, 0x0011].value
+    num_pixels = rows * columns
+    num_bytes = (num_pixels + 7) // 8
+    packed = np.empty((len(datasets), num_bytes), np.uint8)
+    for i, dataset in enumerate(datasets):
+        data = dataset.get((group, 0x3000))
+        if data is None:
+            raise AttributeError("slice {} has no overlay data in group {:#06x}".format(i, group))
+        if (dataset[group, 0x0010].value, dataset[group, 0x0011].value) != (rows, columns):
+            raise ValueError("slice {} has an overlay of a different shape in group {:#06x}".format(i, group))
+        if len(data.value) < num_bytes:
+            raise ValueError("slice {} has a truncated overlay in group {:#06x}".format(i, group))
+        packed[i] = np.frombuffer(data.value, np.uint8, count=num_bytes)
+    # overlay bits are packed little endian, as pydicom does
+    overlays = np.unpackbits(packed, axis=1, count=num_pixels, bitorder='little')
+    return overlays.reshape(len(datasets), rows, columns)
+
+
+def pack_overlays(planes):
+    """
+    pack binary overlay planes as OverlayData, all the slices of each plane with a single np.packbits call
+
+    Args:
+        planes (numpy array): (Z, H, W, N) binary array, N overlay planes of Z slices
+
+    Returns:
+        (numpy array): uint8 (N, Z, bytes) array, the bytes of each slice are padded to an even length
+    """
+    num_slices, num_planes = planes.shape[0], planes.shape[-1]
+    planes = planes.reshape(num_slices, -1, num_planes)
+    # overlay bits are packed little endian, as pydicom does
+    packed = np.packbits(planes, axis=1, bitorder='little')
+    if packed.shape[1] % 2:  # padding if needed
+        packed = np.pad(packed, ((0, 0), (0, 1), (0, 0)))
+    return np.moveaxis(packed, 2, 0)
+
+
+def series_from_dicomdir(dicom_dir):
+    """
+    find the image series of a dicomdir
+
+    Args:
+        dicom_dir (pydicom.dicomdir.DicomDir): dicomdir object
+
+    Returns:
+        (list of str, list of str): filenames of the series and their absolute paths
+    """
 
     dataset_path = os.path.dirname(os.path.abspath(dicom_dir.filename))  # abs path without the final dicomdir
     for patient_record in dicom_dir.patient_records:
@@ -19,9 +212,28 @@ def dicom_from_dicomdir(dicom_dir):
                     image_filenames = [
                         image_rec.ReferencedFileID for image_rec in image_records
                     ]
-                    datasets = [pydicom.dcmread(os.path.join(dataset_path, basename)) for basename in image_filenames]
-                    # raw data stacked together
-                    volume = np.stack([images.pixel_array for images in datasets])
-                    return image_filenames, datasets, volume
+                    paths = [os.path.join(dataset_path, basename) for basename in image_filenames]
+                    return image_filenames, paths
             raise Exception('No valid series found, abort!')
-    raise Exception('no valid patient or study found in the path, abort!')
\ No newline at end of file
+    raise Exception('no valid patient or study found in the path, abort!')
+
+
+def dicom_from_dicomdir(dicom_dir, workers=LOADER_WORKERS, executor='thread', keep_pixel_data=True, step_fn=None):
+    """
+    load the image series of a dicomdir
+
+    Args:
+        dicom_dir (pydicom.dicomdir.DicomDir): dicomdir object
+        workers (int): amount of workers used to read and decode the slices
+        executor (str): kind of pool, one of 'thread' or 'process'
+        keep_pixel_data (bool): if false the raw PixelData of the returned datasets is released
+        step_fn: function to log progress
+
+    Returns:
+        (list of str, list of pydicom.dataset.FileDataset, numpy array): filenames, datasets and raw volume
+    """
+    image_filenames, paths = series_from_dicomdir(dicom_dir)
+    # raw data decoded directly into the volume
+    datasets, volume = load_slices(paths, workers=workers, executor=executor,
+                                   keep_pixel_data=keep_pixel_data, step_fn=step_fn)
+    return image_filenames, datasets, volume
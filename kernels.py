@@ -0,0 +1,281 @@
+import itertools
+import math
+import os
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # optional, not shipped with the frozen builds
+    numba = None
+
+KERNEL_BACKEND_VAR = 'IAN_KERNEL_BACKEND'  # environment variable forcing one of the backends
+KERNEL_BACKENDS = ['numba', 'numpy']
+KERNEL_BACKEND = 'numpy'  # backend in use, see select_backend
+
+
+def select_backend(name=None):
+    """
+    choose the implementation of the kernels: 'numba' compiles them the first time they run,
+    'numpy' are the vectorized fallbacks. by default numba is used whenever it is installed.
+
+    Args:
+        name (str): one of KERNEL_BACKENDS, if None the one in the IAN_KERNEL_BACKEND variable or the fastest available
+
+    Returns:
+        (str): backend in use
+    """
+    global KERNEL_BACKEND
+    if name is None:
+        name = os.environ.get(KERNEL_BACKEND_VAR) or ('numba' if numba is not None else 'numpy')
+        if name not in KERNEL_BACKENDS:
+            print("WARNING: unknown kernel backend {} in {}, using numpy".format(name, KERNEL_BACKEND_VAR))
+            name = 'numpy'
+    if name not in KERNEL_BACKENDS:
+        raise ValueError("unknown kernel backend {}, use one of {}".format(name, KERNEL_BACKENDS))
+    if name == 'numba' and numba is None:
+        print("WARNING: numba is not installed, using numpy kernels")
+        name = 'numpy'
+    KERNEL_BACKEND = name
+    return KERNEL_BACKEND
+
+
+def compiled_fallback(kernel):
+    """
+    run a compiled kernel, moving to the numpy backend if numba fails to compile it
+
+    Args:
+        kernel: function running the compiled kernel
+
+    Returns:
+        (bool): the kernel did run
+    """
+    try:
+        kernel()
+        return True
+    except numba.core.errors.NumbaError as e:
+        print("WARNING: numba kernel failed to compile ({}), using numpy kernels".format(e))
+        select_backend('numpy')
+        return False
+
+
+def clip_coords(coords, maximum):
+    """
+    clip_range on arrays: coords are saturated between 0 and maximum, NaN become 0
+
+    Args:
+        coords (numpy array): float coordinates
+        maximum (int): last valid coordinate
+
+    Returns:
+        (numpy array): clipped coordinates
+    """
+    coords = np.where(maximum < coords, maximum, coords)
+    return np.where(coords > 0, coords, 0)
+
+
+def last_writes(keys):
+    """
+    position of the last write of each distinct key of a sequence of writes, so that
+    a single fancy assignment gives the same result of the writes done one by one
+
+    Args:
+        keys (numpy array): flat destination of each write
+
+    Returns:
+        (numpy array): positions in keys
+    """
+    _, first = np.unique(keys[::-1], return_index=True)
+    return len(keys) - 1 - first
+
+
+def gather_numpy(data, neighbours, strides, out):
+    """numpy implementation of gather"""
+    out[:] = 0
+    for combination in itertools.product(*[range(indices.shape[0]) for indices, _ in neighbours]):
+        index, weight = 0, 1
+        for k, (indices, weights), stride in zip(combination, neighbours, strides):
+            index = index + indices[k] * stride
+            weight = weight * weights[k]
+        values = data[index]
+        if values.ndim > weight.ndim:
+            weight = weight[..., np.newaxis]
+        out += values * weight.astype(out.dtype)
+
+
+def gather_compiled(data, neighbours, strides, out):
+    """
+    run the compiled gather on (P, Q, C) views of the data and of the output
+
+    Returns:
+        (bool): False if the compiled gather cannot run, e.g. the output cannot be viewed as (P, Q, C) without a copy
+    """
+    if len(neighbours) not in (2, 3):
+        return False
+    points = neighbours[0][0].shape[1:]
+    if data.ndim == 1:
+        data, out = data[:, np.newaxis], out[..., np.newaxis]
+    target = out.view()  # the output is written in place, it must not be copied
+    try:
+        target.shape = (-1,) + out.shape[len(points) - 1:]
+    except AttributeError:
+        return False
+    if target.size == 0:
+        return True
+    shape = (neighbours[0][0].shape[0], -1, points[-1])
+    args = [data]
+    for (indices, weights), stride in zip(neighbours, strides):
+        args += [indices.reshape(shape), weights.reshape(shape), stride]
+    kernel = _gather2_numba if len(neighbours) == 2 else _gather3_numba
+    return compiled_fallback(lambda: kernel(*args, target))
+
+
+def gather(data, neighbours, strides, out):
+    """
+    weighted sum of the neighbours of each point. the flat index and the weight of each combination
+    of axis neighbours are computed on the fly, one combination at a time.
+
+    Args:
+        data (numpy array): flattened volume, its first axis is indexed by the flat indices
+        neighbours (list of (numpy array, numpy array)): (K, ...) neighbour indices and weights of each axis
+        strides (list of int): strides of the axes in the flat indices
+        out (numpy array): (...) output, (..., C) if data holds C values for each flat index
+    """
+    if KERNEL_BACKEND == 'numba' and gather_compiled(data, neighbours, strides, out):
+        return
+    gather_numpy(data, neighbours, strides, out)
+
+
+def scatter_columns_numpy(gt_volume, xy, columns, z0):
+    """numpy implementation of scatter_columns"""
+    Z, H, W = gt_volume.shape
+    x, y = xy[:, 0], xy[:, 1]
+    ids = np.flatnonzero((x > -1) & (x < W) & (y > -1) & (y < H))  # 0 <= int(x) < W and 0 <= int(y) < H
+    x, y = clip_coords(x[ids], W - 1), clip_coords(y[ids], H - 1)
+    fx, cx = np.floor(x).astype(np.intp), np.ceil(x).astype(np.intp)
+    fy, cy = np.floor(y).astype(np.intp), np.ceil(y).astype(np.intp)
+    xs = np.stack((fx, cx, fx, cx), axis=1).ravel()
+    ys = np.stack((fy, fy, cy, cy), axis=1).ravel()
+    last = last_writes(ys * W + xs)
+    gt_volume[z0:z0 + columns.shape[0], ys[last], xs[last]] = columns[:, ids[last // 4]]
+
+
+def scatter_columns(gt_volume, xy, columns, z0=0):
+    """
+    write a column of labels on the four voxels around each point, in the order of the points.
+    points whose truncated coordinates are out of the volume are skipped.
+
+    Args:
+        gt_volume (numpy array): (Z, H, W) volume to write
+        xy (numpy array): (N, 2) float xy coordinates of the points
+        columns (numpy array): (h, N) labels of each point
+        z0 (int): slice of the first label of the columns
+    """
+    xy = np.asarray(xy, np.float64).reshape(-1, 2)
+    if KERNEL_BACKEND == 'numba' and compiled_fallback(lambda: _scatter_columns_numba(gt_volume, xy, columns, z0)):
+        return
+    scatter_columns_numpy(gt_volume, xy, columns, z0)
+
+
+def scatter_voxels_numpy(gt_volume, values, x, y, z):
+    """numpy implementation of scatter_voxels"""
+    Z, H, W = gt_volume.shape
+    x, y, z = clip_coords(x, W - 1), clip_coords(y, H - 1), clip_coords(z, Z - 1)
+    fx, cx = np.floor(x).astype(np.intp), np.ceil(x).astype(np.intp)
+    fy, cy = np.floor(y).astype(np.intp), np.ceil(y).astype(np.intp)
+    fz, cz = np.floor(z).astype(np.intp), np.ceil(z).astype(np.intp)
+    xs = np.stack((fx, cx, fx, cx, fx, cx, fx, cx), axis=1).ravel()
+    ys = np.stack((fy, fy, cy, cy, fy, fy, cy, cy), axis=1).ravel()
+    zs = np.stack((fz, fz, fz, fz, cz, cz, cz, cz), axis=1).ravel()
+    last = last_writes((zs * H + ys) * W + xs)
+    gt_volume[zs[last], ys[last], xs[last]] = values[last // 8]
+
+
+def scatter_voxels(gt_volume, values, x, y, z):
+    """
+    write each label on the eight voxels around its float position, in the order of the labels.
+    positions are clipped within the volume.
+
+    Args:
+        gt_volume (numpy array): (Z, H, W) volume to write
+        values (numpy array): labels
+        x (numpy array): x coordinates, same shape of values
+        y (numpy array): y coordinates, same shape of values
+        z (numpy array): z coordinates, same shape of values
+    """
+    values = np.asarray(values).ravel()
+    x, y, z = [np.asarray(coords, np.float64).ravel() for coords in (x, y, z)]
+    if KERNEL_BACKEND == 'numba' and compiled_fallback(lambda: _scatter_voxels_numba(gt_volume, values, x, y, z)):
+        return
+    scatter_voxels_numpy(gt_volume, values, x, y, z)
+
+
+if numba is not None:
+    @numba.njit(nogil=True, cache=True)
+    def _gather2_numba(data, i0, w0, s0, i1, w1, s1, out):
+        """gather of (M, C) data into (P, Q, C) out along two axes of (K, P, Q) neighbours"""
+        P, Q, C = out.shape
+        cast = out.dtype.type
+        for p in range(P):
+            for q in range(Q):
+                for c in range(C):
+                    out[p, q, c] = 0
+                for k0 in range(i0.shape[0]):  # the last axis changes faster, as itertools.product
+                    for k1 in range(i1.shape[0]):
+                        index = i0[k0, p, q] * s0 + i1[k1, p, q] * s1
+                        weight = cast(w0[k0, p, q] * w1[k1, p, q])
+                        for c in range(C):
+                            out[p, q, c] += data[index, c] * weight
+
+    @numba.njit(nogil=True, cache=True)
+    def _gather3_numba(data, i0, w0, s0, i1, w1, s1, i2, w2, s2, out):
+        """gather of (M, C) data into (P, Q, C) out along three axes of (K, P, Q) neighbours"""
+        P, Q, C = out.shape
+        cast = out.dtype.type
+        for p in range(P):
+            for q in range(Q):
+                for c in range(C):
+                    out[p, q, c] = 0
+                for k0 in range(i0.shape[0]):
+                    for k1 in range(i1.shape[0]):
+                        for k2 in range(i2.shape[0]):
+                            index = i0[k0, p, q] * s0 + i1[k1, p, q] * s1 + i2[k2, p, q] * s2
+                            weight = cast(w0[k0, p, q] * w1[k1, p, q] * w2[k2, p, q])
+                            for c in range(C):
+                                out[p, q, c] += data[index, c] * weight
+
+    @numba.njit(nogil=True, cache=True)
+    def _clip_coord(coord, maximum):
+        """clip_range of a single coordinate"""
+        if maximum < coord:
+            coord = maximum
+        return coord if coord > 0 else 0.
+
+    @numba.njit(nogil=True, cache=True)
+    def _scatter_columns_numba(gt_volume, xy, columns, z0):
+        """compiled scatter_columns"""
+        Z, H, W = gt_volume.shape
+        h = columns.shape[0]
+        for i in range(xy.shape[0]):
+            x, y = xy[i, 0], xy[i, 1]
+            if not (-1 < x < W and -1 < y < H):
+                continue
+            x, y = _clip_coord(x, W - 1), _clip_coord(y, H - 1)
+            fx, cx, fy, cy = math.floor(x), math.ceil(x), math.floor(y), math.ceil(y)
+            for j in range(h):
+                gt_volume[z0 + j, fy, fx] = columns[j, i]
+                gt_volume[z0 + j, fy, cx] = columns[j, i]
+                gt_volume[z0 + j, cy, fx] = columns[j, i]
+                gt_volume[z0 + j, cy, cx] = columns[j, i]
+
+    @numba.njit(nogil=True, cache=True)
+    def _scatter_voxels_numba(gt_volume, values, x, y, z):
+        """compiled scatter_voxels"""
+        Z, H, W = gt_volume.shape
+        for i in range(values.shape[0]):
+            x_, y_, z_ = _clip_coord(x[i], W - 1), _clip_coord(y[i], H - 1), _clip_coord(z[i], Z - 1)
+            for z__ in (math.floor(z_), math.ceil(z_)):
+                for y__ in (math.floor(y_), math.ceil(y_)):
+                    for x__ in (math.floor(x_), math.ceil(x_)):
+                        gt_volume[z__, y__, x__] = values[i]
+
+select_backend()
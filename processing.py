@@ -39,17 +39,17 @@ def compute_skeleton(img):
     """
 
     img = img.astype(np.uint8)
-    size = img.size
     skel = np.zeros(img.shape, np.uint8)
     kernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+    # every step works in place on the same buffers, no copies of the image
+    eroded, temp = np.empty_like(img), np.empty_like(img)
     while True:
-        eroded = cv2.erode(img, kernel)
-        temp = cv2.dilate(eroded, kernel)
-        temp = cv2.subtract(img, temp)
-        skel = np.bitwise_or(skel, temp)
-        img = eroded.copy()
-        zeros = size - cv2.countNonZero(img)
-        if zeros == size:
+        cv2.erode(img, kernel, dst=eroded)
+        cv2.dilate(eroded, kernel, dst=temp)
+        cv2.subtract(img, temp, dst=temp)
+        cv2.bitwise_or(skel, temp, dst=skel)
+        img, eroded = eroded, img
+        if cv2.countNonZero(img) == 0:
             return skel
 
 
@@ -237,6 +237,25 @@ def increase_contrast(image):
     return sharp
 
 
+def area_downsample(volume, chunk_slices=32):
+    """
+    halve each axis of a volume by averaging blocks of 2x2x2 voxels. odd trailing voxels are dropped
+    Args:
+        volume (numpy array): 3D volume
+        chunk_slices (int): amount of slices averaged at once, it bounds the memory of the temporaries
+    Returns:
+        result (numpy array): float32 volume of shape (Z // 2, H // 2, W // 2)
+    """
+    Z, H, W = (n // 2 for n in volume.shape)
+    result = np.empty((Z, H, W), np.float32)
+    step = chunk_slices - chunk_slices % 2
+    for z in range(0, Z * 2, step):
+        chunk = volume[z:min(z + step, Z * 2), :H * 2, :W * 2].astype(np.float32)
+        blocks = chunk.reshape(chunk.shape[0] // 2, 2, H, 2, W, 2)
+        result[z // 2:z // 2 + blocks.shape[0]] = blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+    return result
+
+
 def grey_to_rgb(grey):
     """
     create a color image/volume from its grey scale version
@@ -0,0 +1,501 @@
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing import cpu_count
+
+from kernels import gather
+
+LINE_BORDER = 2  # points of a line closer than this to the border of the volume are left black
+MEMORY_BUDGET = 64 * 2 ** 20  # bytes of temporary arrays of a resampling, shared by its workers
+INDEX_BYTES = np.dtype(np.intp).itemsize + np.dtype(np.float64).itemsize  # flat index and weight of a point
+RESAMPLING_WORKERS = cpu_count()  # default amount of threads of the resampling of many cuts
+
+# interpolation of each axis for the resampling methods
+LINE_METHODS = {'nearest': 'nearest', 'bilinear': 'linear', 'bicubic': 'cubic'}
+PLANE_METHODS = {'nearest': 'nearest', 'trilinear': 'linear', 'tricubic': 'cubic'}
+AXIS_NEIGHBOURS = {'nearest': 1, 'linear': 2, 'cubic': 4}  # neighbours of a point along each axis
+
+
+def wrap_indices(indices, size):
+    """
+    negative indices count from the end of the axis as python does, indices past the end are clamped on the last one
+
+    Args:
+        indices (numpy array): integer indices
+        size (int): size of the axis
+
+    Returns:
+        (numpy array): indices between 0 and size - 1
+    """
+    return np.where(indices < 0, indices % size, np.minimum(indices, size - 1))
+
+
+def cubic_weights(t):
+    """
+    weights of the four points p0, p1, p2, p3 of the cubic interpolation at t, with t between p1 and p2.
+    same polynomial of Jaw.cubic_interpolation (https://www.paulinternet.nl/?page=bicubic)
+
+    Args:
+        t (numpy array): distance from p1
+
+    Returns:
+        (numpy array): (4, ...) weights
+    """
+    t2, t3 = t * t, t * t * t
+    return 0.5 * np.stack((-t + 2 * t2 - t3, 2 - 5 * t2 + 3 * t3, t + 4 * t2 - 3 * t3, t3 - t2))
+
+
+def axis_neighbours(coords, size, kind):
+    """
+    neighbours and weights of a set of coordinates along one axis of the volume.
+        - nearest: coordinates are truncated
+        - linear: coordinates within one voxel from the end of the axis are moved back on the second to last voxel
+        - cubic: the four neighbours are clamped on the borders of the axis
+    as python indexing does, negative indices of nearest and linear neighbours wrap around.
+
+    Args:
+        coords (numpy array): float coordinates
+        size (int): size of the axis
+        kind (str): 'nearest', 'linear' or 'cubic'
+
+    Returns:
+        (numpy array, numpy array): (K, ...) indices of the K neighbours and their float64 weights
+    """
+    if kind == 'nearest':
+        return wrap_indices(coords.astype(np.intp), size)[np.newaxis], np.ones((1,) + coords.shape)
+    if kind == 'linear':
+        coords = np.where(coords + 1 >= size, size - 2, coords)  # avoid possible overflows
+        first = np.floor(coords).astype(np.intp)
+        d = coords - first
+        return np.stack((wrap_indices(first, size), wrap_indices(first + 1, size))), np.stack((1 - d, d))
+    if kind == 'cubic':
+        first = np.floor(coords).astype(np.intp)
+        indices = np.stack([np.clip(first + offset, 0, size - 1) for offset in (-1, 0, 1, 2)])
+        return indices, cubic_weights(coords - first)
+    raise ValueError("unknown interpolation {}".format(kind))
+
+
+def line_neighbours(xy_set, shape, method='bilinear'):
+    """
+    neighbour columns and weights of each point of a set of lines of xy coordinates, along the y and x axes.
+    points closer than LINE_BORDER to the border of the volume get null weights, so that they are resampled as 0.
+
+    Args:
+        xy_set (numpy array): (N, W, 2) set of N lines of W xy coordinates
+        shape ((int, int)): H and W of the volume
+        method (str): 'nearest', 'bilinear' or 'bicubic'
+
+    Returns:
+        (list of (numpy array, numpy array)): (K, N, W) neighbour indices and weights of the y and x axes
+    """
+    if method not in LINE_METHODS:
+        raise ValueError("unknown method {}, use one of {}".format(method, list(LINE_METHODS.keys())))
+    H, W = shape
+    x, y = xy_set[..., 0], xy_set[..., 1]
+    valid = ~(((x - LINE_BORDER) < 0) | ((y - LINE_BORDER) < 0) | ((x + LINE_BORDER) >= W) | ((y + LINE_BORDER) >= H))
+    # out of border points are moved on the first column, their weights are null anyway
+    x, y = np.where(valid, x, 0), np.where(valid, y, 0)
+    y_indices, y_weights = axis_neighbours(y, H, LINE_METHODS[method])
+    x_indices, x_weights = axis_neighbours(x, W, LINE_METHODS[method])
+    return [(y_indices, y_weights), (x_indices, x_weights * valid)]
+
+
+def plane_neighbours(planes, shape, method='trilinear'):
+    """
+    neighbour voxels and weights of each point of a set of planes of xyz coordinates, along the z, y and x axes.
+
+    Args:
+        planes (numpy array): (..., 3, Z, W) planes of coordinates, ordered as [0] x, [1] y, [2] z
+        shape ((int, int, int)): Z, H and W of the volume
+        method (str): 'nearest', 'trilinear' or 'tricubic'
+
+    Returns:
+        (list of (numpy array, numpy array)): (K, ..., Z, W) neighbour indices and weights of the z, y and x axes
+    """
+    if method not in PLANE_METHODS:
+        raise ValueError("unknown method {}, use one of {}".format(method, list(PLANE_METHODS.keys())))
+    return [
+        axis_neighbours(planes[..., axis, :, :], size, PLANE_METHODS[method])
+        for axis, size in zip((2, 1, 0), shape)
+    ]
+
+
+def chunk_size(item_bytes, memory_budget=MEMORY_BUDGET, workers=1):
+    """
+    amount of items resampled at once, so that the temporary arrays of all the workers fit in the memory budget.
+    at least one item is resampled at once, whatever the budget
+
+    Args:
+        item_bytes (int): bytes of the temporary arrays of a single item
+        memory_budget (int): bytes available for the temporary arrays
+        workers (int): amount of chunks resampled at the same time
+
+    Returns:
+        (int): items of a chunk
+    """
+    return max(1, int(memory_budget // (max(1, workers) * max(1, item_bytes))))
+
+
+def run_chunks(fn, total, size, workers=1, step_fn=None, cancel_event=None):
+    """
+    call fn on consecutive chunks of a range of items, sequentially or on a pool of threads.
+    numpy releases the GIL while gathering, so threads resample different chunks at the same time.
+    each chunk writes its own items only, so the result does not depend on the amount of workers.
+
+    Args:
+        fn: function of the first and the last (excluded) item of a chunk
+        total (int): amount of items
+        size (int): items of a chunk
+        workers (int): amount of threads, 1 runs the chunks sequentially
+        step_fn: function to log progress
+        cancel_event (threading.Event): once set, the chunks not started yet are skipped
+
+    Returns:
+        (bool): false if the run was canceled
+    """
+    canceled = cancel_event.is_set if cancel_event is not None else lambda: False
+    chunks = [(start, min(start + size, total)) for start in range(0, total, size)]
+    if workers is None or workers < 2 or len(chunks) < 2:
+        for start, stop in chunks:
+            if canceled():
+                return False
+            step_fn is not None and step_fn(start, total)
+            fn(start, stop)
+        return not canceled()
+
+    def run(start, stop):
+        if not canceled():
+            fn(start, stop)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run, start, stop): stop - start for start, stop in chunks}
+        done = 0
+        for future in as_completed(futures):
+            future.result()
+            done += futures.pop(future)
+            step_fn is not None and step_fn(done, total)
+    return not canceled()
+
+
+def coords_neighbours(coords, shape, method='bilinear'):
+    """
+    neighbour columns and weights of a line of xy coordinates, with the bounds of Jaw.bilinear_interpolation:
+    points with a neighbour past the end of the volume get null weights, negative indices wrap around.
+
+    Args:
+        coords (numpy array): (W, 2) line of xy coordinates
+        shape ((int, int)): H and W of the volume
+        method (str): 'bilinear'
+
+    Returns:
+        (list of (numpy array, numpy array)): (K, 1, W) neighbour indices and weights of the y and x axes
+    """
+    if method != 'bilinear':
+        raise ValueError("unknown method {}, use bilinear".format(method))
+    H, W = shape
+    x, y = coords[np.newaxis, :, 0], coords[np.newaxis, :, 1]
+    x1, y1 = np.floor(x).astype(np.intp), np.floor(y).astype(np.intp)
+    valid = (x1 >= -W) & (x1 + 1 < W) & (y1 >= -H) & (y1 + 1 < H)
+    # out of bounds points are moved on the first column, their weights are null anyway
+    x1, y1 = np.where(valid, x1, 0), np.where(valid, y1, 0)
+    dx, dy = np.where(valid, x - x1, 0), np.where(valid, y - y1, 0)
+    return [
+        (np.stack((y1 % H, (y1 + 1) % H)), np.stack((1 - dy, dy))),
+        (np.stack((x1 % W, (x1 + 1) % W)), np.stack((1 - dx, dx)) * valid),
+    ]
+
+
+class ResamplingPlan:
+    COLUMNS = 'columns'  # points pick Z columns of the volume: (N, W) points give (N, Z, W) cuts
+    VOXELS = 'voxels'  # points pick single voxels of the volume: (..., Z, W) points give (..., Z, W) cuts
+
+    def __init__(self, kind, shape, neighbours, dtype):
+        """
+        Neighbour indices and interpolation weights of a set of points, computed once and applied to any volume
+        of the same shape with a single gather-multiply-sum.
+
+        Args:
+            kind (str): ResamplingPlan.COLUMNS or ResamplingPlan.VOXELS
+            shape ((int, int, int)): shape of the volumes the plan applies to
+            neighbours (list of (numpy array, numpy array)): (K, ...) neighbour indices and weights of each axis
+            dtype: type of the resampled data
+        """
+        self.kind = kind
+        self.shape = tuple(int(n) for n in shape)
+        self.neighbours = neighbours
+        self.dtype = np.dtype(dtype)
+
+    @staticmethod
+    def compute_key(geometry, coords, shape, method):
+        """
+        digest of the geometry of a plan, to cache plans and to check them after loading
+
+        Args:
+            geometry (str): kind of coordinates, 'lines', 'coords' or 'planes' (see build)
+            coords (numpy array): coordinates of the points
+            shape ((int, int, int)): shape of the volume
+            method (str): resampling method
+
+        Returns:
+            (str): hex digest
+        """
+        coords = np.ascontiguousarray(coords, np.float64)
+        digest = hashlib.sha1("{}:{}:{}:{}".format(geometry, tuple(shape), method, coords.shape).encode())
+        digest.update(coords.tobytes())
+        return digest.hexdigest()
+
+    @classmethod
+    def build(cls, geometry, coords, shape, method):
+        """
+        build the plan of a kind of coordinates
+
+        Args:
+            geometry (str): 'lines' for side_coords (see from_lines), 'coords' for arch coordinates (see from_coords)
+                or 'planes' for planes (see from_planes)
+            coords (numpy array): coordinates of the points
+            shape ((int, int, int)): shape of the volume
+            method (str): resampling method
+
+        Returns:
+            (ResamplingPlan): the plan
+        """
+        builders = {'lines': cls.from_lines, 'coords': cls.from_coords, 'planes': cls.from_planes}
+        if geometry not in builders:
+            raise ValueError("unknown geometry {}, use one of {}".format(geometry, list(builders.keys())))
+        return builders[geometry](coords, shape, method)
+
+    @classmethod
+    def from_lines(cls, xy_set, shape, method='bilinear'):
+        """
+        plan of a set of side_coords lines, see line_neighbours
+
+        Args:
+            xy_set (numpy array): (N, W, 2) set of N lines of W xy coordinates
+            shape ((int, int, int)): shape of the volume
+            method (str): 'nearest', 'bilinear' or 'bicubic'
+
+        Returns:
+            (ResamplingPlan): plan of (N, Z, W) float32 cuts
+        """
+        return cls(cls.COLUMNS, shape, line_neighbours(np.asarray(xy_set), shape[1:], method), np.float32)
+
+    @classmethod
+    def from_coords(cls, coords, shape, method='bilinear'):
+        """
+        plan of a line of arch coordinates for a panorex, see coords_neighbours
+
+        Args:
+            coords (numpy array): (W, 2) line of xy coordinates
+            shape ((int, int, int)): shape of the volume
+            method (str): 'bilinear'
+
+        Returns:
+            (ResamplingPlan): plan of a (1, Z, W) float32 panorex
+        """
+        coords = np.asarray(coords, np.float64).reshape(-1, 2)
+        return cls(cls.COLUMNS, shape, coords_neighbours(coords, shape[1:], method), np.float32)
+
+    @classmethod
+    def from_planes(cls, planes, shape, method='trilinear'):
+        """
+        plan of a plane or of a stack of planes, see plane_neighbours
+
+        Args:
+            planes (numpy array): (3, Z, W) plane or (N, 3, Z, W) stack of planes, ordered as [0] x, [1] y, [2] z
+            shape ((int, int, int)): shape of the volume
+            method (str): 'nearest', 'trilinear' or 'tricubic'
+
+        Returns:
+            (ResamplingPlan): plan of (Z, W) or (N, Z, W) float64 cuts
+        """
+        return cls(cls.VOXELS, shape, plane_neighbours(np.asarray(planes), shape, method), np.float64)
+
+    def get_z_range(self, z_range=None):
+        """
+        slices picked by a column plan
+
+        Args:
+            z_range ((int, int)): optional first and last (excluded) slice, the whole Z axis if None
+
+        Returns:
+            (int, int): first and last (excluded) slice
+        """
+        if z_range is None:
+            return 0, self.shape[0]
+        if self.kind != self.COLUMNS:
+            raise ValueError("only column plans can be cropped along Z, crop the planes instead")
+        z0, z1 = int(z_range[0]), int(z_range[1])
+        if not 0 <= z0 < z1 <= self.shape[0]:
+            raise ValueError("invalid Z range {} for a volume of {} slices".format(z_range, self.shape[0]))
+        return z0, z1
+
+    def get_shape(self, z_range=None):
+        """
+        Args:
+            z_range ((int, int)): optional first and last (excluded) slice picked by a column plan
+
+        Returns:
+            (tuple): shape of the resampled data
+        """
+        points = self.neighbours[0][0].shape[1:]
+        if self.kind == self.COLUMNS:
+            z0, z1 = self.get_z_range(z_range)
+            return (points[0], z1 - z0) + points[1:]
+        return points
+
+    def get_item_bytes(self, data_dtype, z_range=None):
+        """
+        bytes of the temporary arrays needed to resample a single item of the first axis of the points:
+        flat indices and weights of a combination of neighbours, the gathered values and their weighted sum
+
+        Args:
+            data_dtype: type of the volume
+            z_range ((int, int)): optional first and last (excluded) slice picked by a column plan
+
+        Returns:
+            (int): bytes
+        """
+        points = int(np.prod(self.neighbours[0][0].shape[2:], dtype=np.int64))
+        z0, z1 = self.get_z_range(z_range)
+        depth = z1 - z0 if self.kind == self.COLUMNS else 1  # values gathered for each point
+        out_bytes = self.dtype.itemsize
+        return points * (INDEX_BYTES + out_bytes + depth * (np.dtype(data_dtype).itemsize + out_bytes))
+
+    def apply(self, volume, out=None, step_fn=None, columns=None, memory_budget=MEMORY_BUDGET, workers=1,
+              cancel_event=None, z_range=None):
+        """
+        resample a volume in chunks along the first axis of the points. the chunks are sized on the memory budget
+        and written straight into the output, so the extra memory does not depend on the size of the volume.
+
+        Args:
+            volume (numpy array): volume with the shape of the plan
+            out (numpy array): optional preallocated output, see get_shape
+            step_fn: function to log progress
+            columns (numpy array): optional (H, W, Z) C-contiguous copy of the volume. column plans read it in place
+                of the volume, so that each Z column is gathered from contiguous memory
+            memory_budget (int): bytes of temporary arrays, see chunk_size
+            workers (int): amount of threads resampling the chunks
+            cancel_event (threading.Event): once set the resampling stops, leaving the output incomplete
+            z_range ((int, int)): optional first and last (excluded) slice picked by a column plan,
+                the other slices are neither read nor stored
+
+        Returns:
+            (numpy array): resampled data, None if the resampling was canceled
+        """
+        if tuple(volume.shape) != self.shape:
+            raise ValueError("the plan is for volumes of shape {}, got {}".format(self.shape, volume.shape))
+        shape = self.get_shape(z_range)
+        if out is None:
+            out = np.empty(shape, self.dtype)
+        elif out.shape != shape:
+            raise ValueError("the output must have shape {}, got {}".format(shape, out.shape))
+        Z, H, W = self.shape
+        z0, z1 = self.get_z_range(z_range)
+        if self.kind == self.COLUMNS:
+            # Z columns of the volume, gathered values are (N, W, Z)
+            data = columns.reshape(H * W, Z) if columns is not None else volume.reshape(Z, -1).T
+            data, strides, target = data[:, z0:z1], (W, 1), np.moveaxis(out, 1, -1)
+        else:
+            data, strides, target = volume.reshape(-1), (H * W, W, 1), out
+
+        def resample(start, stop):
+            chunk = [(indices[:, start:stop], weights[:, start:stop]) for indices, weights in self.neighbours]
+            gather(data, chunk, strides, target[start:stop])
+
+        size = chunk_size(self.get_item_bytes(data.dtype, z_range), memory_budget, workers)
+        if not run_chunks(resample, target.shape[0] if target.ndim else 1, size, workers, step_fn, cancel_event):
+            return None
+        return out
+
+    def save(self, path, key=None):
+        """
+        store the plan in a npz file
+
+        Args:
+            path (str): path of the file
+            key (str): optional digest of the geometry (see compute_key), stored to check the plan when loading it
+        """
+        arrays = {'kind': np.array(self.kind), 'shape': np.array(self.shape), 'dtype': np.array(self.dtype.str),
+                  'key': np.array(key or '')}
+        for axis, (indices, weights) in enumerate(self.neighbours):
+            arrays['indices_{}'.format(axis)] = indices
+            arrays['weights_{}'.format(axis)] = weights
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        load a plan stored with save
+
+        Args:
+            path (str): path of the file
+
+        Returns:
+            (ResamplingPlan, str): plan and digest of its geometry, empty if it was not stored
+        """
+        with np.load(path) as data:
+            neighbours = []
+            while 'indices_{}'.format(len(neighbours)) in data:
+                axis = len(neighbours)
+                neighbours.append((data['indices_{}'.format(axis)], data['weights_{}'.format(axis)]))
+            plan = cls(str(data['kind']), data['shape'], neighbours, str(data['dtype']))
+            return plan, str(data['key'])
+
+
+def line_slice(volume, xy_set, method='bilinear', out=None, step_fn=None, memory_budget=MEMORY_BUDGET, workers=1,
+               z_range=None):
+    """
+    resample the volume along a set of lines of xy coordinates, each line is cut across the whole Z axis
+    or across a range of slices.
+
+    Args:
+        volume (numpy array): (Z, H, W) volume
+        xy_set (numpy array): (N, W, 2) set of N lines of W xy coordinates
+        method (str): 'nearest', 'bilinear' or 'bicubic'
+        out (numpy array): optional (N, Z, W) output
+        step_fn: function to log progress
+        memory_budget (int): bytes of temporary arrays, see chunk_size
+        workers (int): amount of threads resampling the cuts
+        z_range ((int, int)): optional first and last (excluded) slice of the cuts
+
+    Returns:
+        (numpy array): (N, Z, W) float32 cuts, Z is the size of z_range if given
+    """
+    plan = ResamplingPlan.from_lines(xy_set, volume.shape, method)
+    return plan.apply(volume, out, step_fn, memory_budget=memory_budget, workers=workers, z_range=z_range)
+
+
+def plane_slice(volume, planes, method='trilinear', out=None, memory_budget=MEMORY_BUDGET, workers=1):
+    """
+    resample the volume on a plane or a stack of planes of xyz coordinates. the plans of a stack are built
+    one chunk of planes at a time, so that neighbours and weights of the whole stack are never held in memory.
+
+    Args:
+        volume (numpy array): (Z, H, W) volume
+        planes (numpy array): (3, Z, W) plane or (N, 3, Z, W) stack of planes, ordered as [0] x, [1] y, [2] z
+        method (str): 'nearest', 'trilinear' or 'tricubic'
+        out (numpy array): optional (Z, W) or (N, Z, W) output
+        memory_budget (int): bytes of temporary arrays, see chunk_size
+        workers (int): amount of threads resampling the planes
+
+    Returns:
+        (numpy array): (Z, W) or (N, Z, W) float64 cut(s)
+    """
+    if planes.ndim == 3:
+        plan = ResamplingPlan.from_planes(planes, volume.shape, method)
+        return plan.apply(volume, out, memory_budget=memory_budget, workers=workers)
+    if out is None:
+        out = np.empty((planes.shape[0],) + planes.shape[2:], np.float64)
+
+    if method not in PLANE_METHODS:
+        raise ValueError("unknown method {}, use one of {}".format(method, list(PLANE_METHODS.keys())))
+    workers = max(1, workers or 1)
+
+    def resample(start, stop):
+        plan = ResamplingPlan.from_planes(planes[start:stop], volume.shape, method)
+        plan.apply(volume, out[start:stop], memory_budget=memory_budget / (2 * workers))
+
+    # half of the budget holds the plans, neighbours and weights of the points of a plane along the three axes
+    item_bytes = int(np.prod(planes.shape[2:])) * 3 * AXIS_NEIGHBOURS[PLANE_METHODS[method]] * INDEX_BYTES
+    run_chunks(resample, planes.shape[0], chunk_size(item_bytes, memory_budget / 2, workers), workers)
+    return out
@@ -0,0 +1,65 @@
+import time
+import numpy as np
+import processing
+from tests.test_low_memory_volume import load_jaw
+
+REPEATS = 5
+SHAPE = (200, 400, 400)
+
+
+def timeit(fn):
+    """best time of REPEATS runs of fn, in seconds"""
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def column_layout_benchmark():
+    """
+    throughput of the Z column gathers on the (Z, H, W) volume and on its (H, W, Z) contiguous copy:
+    line_slice, create_panorex, bilinear_interpolation and the column writes of the gt volume
+    """
+
+    rng = np.random.default_rng(0)
+    jaw = load_jaw(rng.integers(0, 3000, size=SHAPE).astype(np.int16), low_memory=False)
+    jaw.z_contiguous = True
+    jaw.get_column_volume()  # built once, out of the timings
+
+    # parabolic arch across the slices, in place of the one detected on a real scan
+    p, start, end = np.poly1d([-0.005, 2, 100]), 60, jaw.W - 60
+    l_offset, coords, h_offset, derivative = processing.arch_lines(p, start, end)
+    side_coords = processing.generate_side_coords(h_offset, l_offset, derivative)
+    points = np.concatenate(side_coords)
+    # points whose four neighbours are within the volume
+    points = points[(points[:, 0] >= 0) & (points[:, 0] < jaw.W - 1) & (points[:, 1] >= 0) & (points[:, 1] < jaw.H - 1)]
+    columns = np.floor(points).astype(int)
+
+    def write_columns(gt_volume):
+        column = np.arange(jaw.Z, dtype=np.uint8)
+        for x, y in columns:
+            gt_volume[:, y, x] = column
+
+    benchmarks = {
+        'line_slice': lambda: jaw.line_slice(side_coords),
+        'create_panorex': lambda: jaw.create_panorex(h_offset),
+        'bilinear_interpolation': lambda: [jaw.bilinear_interpolation(x, y) for x, y in points],
+    }
+    print("volume {}, {} cuts, {} points".format(jaw.volume.shape, len(side_coords), len(points)))
+    for name, fn in benchmarks.items():
+        fn()  # resampling plans are built before the timings
+        jaw.z_contiguous = False
+        zhw = timeit(fn)
+        jaw.z_contiguous = True
+        hwz = timeit(fn)
+        print("{:<24} (Z, H, W) {:8.4f}s  (H, W, Z) {:8.4f}s  speedup {:.2f}x".format(name, zhw, hwz, zhw / hwz))
+
+    zhw = timeit(lambda: write_columns(np.zeros((jaw.Z, jaw.H, jaw.W), np.uint8)))
+    hwz = timeit(lambda: write_columns(np.moveaxis(np.zeros((jaw.H, jaw.W, jaw.Z), np.uint8), -1, 0)))
+    print("{:<24} (Z, H, W) {:8.4f}s  (H, W, Z) {:8.4f}s  speedup {:.2f}x".format("gt column writes", zhw, hwz, zhw / hwz))
+
+
+if __name__ == "__main__":
+    column_layout_benchmark()
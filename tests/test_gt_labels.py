@@ -0,0 +1,26 @@
+import numpy as np
+
+from conf import labels as l
+from tests.test_low_memory_volume import load_jaw
+
+
+def test_gt_labels_round_trip():
+    """labels written by overwrite_annotations are decoded on request when the series is opened again"""
+    rng = np.random.default_rng(2)
+    raw = rng.integers(0, 1000, size=(4, 9, 11)).astype(np.int16)
+    jaw = load_jaw(raw, low_memory=False)
+    assert jaw.get_gt_labels() is None
+
+    gt = rng.choice([l.CONTOUR, l.INSIDE, l.BG, l.UNLABELED], size=raw.shape).astype(np.uint8)
+    jaw.set_gt_volume(gt)
+    jaw.overwrite_annotations()
+
+    reopened = load_jaw(raw, low_memory=False, datasets=jaw.dicom_files)
+    assert reopened.gt_labels is None  # not decoded until requested
+    assert np.array_equal(reopened.get_gt_labels(), gt)
+    assert np.array_equal(reopened.get_gt_volume(), np.isin(gt, [l.CONTOUR, l.INSIDE]))
+
+
+if __name__ == "__main__":
+    test_gt_labels_round_trip()
+    print("gt labels: OK")
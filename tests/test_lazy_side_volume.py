@@ -0,0 +1,51 @@
+import os
+import tempfile
+
+import numpy as np
+
+from annotation.components.message.Messenger import Messenger
+from annotation.components.message.Strategies import TerminalMessageStrategy
+from annotation.core.SideVolume import SideVolume, LazySideVolume
+from tests.test_low_memory_volume import load_jaw
+
+
+def synthetic_side_coords(n=12, w=16):
+    """n lines of w xy coords across a small arch"""
+    t = np.linspace(0, 1, n)
+    xs, ys = 8 + 30 * t, 12 + 14 * (1 - (2 * t - 1) ** 2)
+    offsets = np.linspace(-5, 5, w)
+    return np.stack([np.stack([x + offsets, y + 2 * offsets], axis=1) for x, y in zip(xs, ys)])
+
+
+def test_lazy_side_volume():
+    """images of a lazy side volume match the ones of SideVolume, computed on request or materialized"""
+    Messenger(TerminalMessageStrategy())
+    rng = np.random.default_rng(3)
+    raw = rng.integers(300, 2000, size=(10, 40, 48)).astype(np.int16)
+    # plateaus at the clip bounds: the cuts span the bounds of the volume, which lazy images are normalized on
+    raw[:, :10], raw[:, 30:] = 300, 2000
+    jaw = load_jaw(raw, low_memory=False)
+    assert jaw.get_min_max()[0] > 0
+    jaw.side_coords = synthetic_side_coords()
+    jaw.coords = tuple(np.zeros(3) for _ in range(4))
+    with tempfile.TemporaryDirectory() as tmp:
+        jaw.dicomdir_path = os.path.join(tmp, 'DICOMDIR')
+        saved = os.path.join(tmp, SideVolume.SAVE_DIRNAME, SideVolume.SIDE_VOLUME_FILENAME)
+        eager = SideVolume(jaw, 2)
+        saved_images = np.load(saved)
+
+        lazy = LazySideVolume(jaw, 2)
+        assert lazy.data is None and lazy.get_shape() == eager.get_shape()
+        for pos in [3, 4, 5, 11, 10, 0]:
+            assert np.allclose(lazy.get_slice(pos), eager.data[pos], rtol=0, atol=1e-6)
+        assert np.array_equal(np.load(saved), saved_images)  # nothing is saved before being materialized
+
+        images = [lazy.get_slice(pos) for pos in range(len(jaw.side_coords))]
+        assert lazy.materialize()
+        assert np.array_equal(lazy.data, np.stack(images))
+        assert np.allclose(np.load(saved), eager.original, rtol=0, atol=1e-6)
+
+
+if __name__ == "__main__":
+    test_lazy_side_volume()
+    print("lazy side volume: OK")
@@ -0,0 +1,57 @@
+import numpy as np
+from pydicom.dataset import Dataset
+
+import Jaw as jaw_module
+from Jaw import Jaw, MIN_QUANTILE, MAX_QUANTILE
+
+
+def synthetic_series(volume):
+    """headers of a fake series of volume.shape[0] slices, without rescale tags (HU = raw - 1000)"""
+    datasets = []
+    for z in range(volume.shape[0]):
+        ds = Dataset()
+        ds.WindowCenter = 40
+        ds.WindowWidth = 400
+        ds.ImagePositionPatient = [0., 0., float(-z)]
+        datasets.append(ds)
+    return datasets
+
+
+def load_jaw(volume, low_memory, datasets=None):
+    """Jaw of a synthetic volume, the DICOM readers are replaced by the in memory series"""
+    readers = jaw_module.read_dicomdir, jaw_module.series_from_dicomdir, jaw_module.load_slices
+    names = ["{}".format(z) for z in range(volume.shape[0])]
+    datasets = synthetic_series(volume) if datasets is None else list(datasets)
+    jaw_module.read_dicomdir = lambda path: None
+    jaw_module.series_from_dicomdir = lambda dicom_dir: (list(names), list(names))
+    jaw_module.load_slices = lambda paths, **kwargs: (datasets, volume.copy())
+    try:
+        return Jaw('DICOMDIR', use_cache=False, low_memory=low_memory)
+    finally:
+        jaw_module.read_dicomdir, jaw_module.series_from_dicomdir, jaw_module.load_slices = readers
+
+
+def test_low_memory_volume_negative_raw():
+    """signed raw values with non-integer negative quantiles give the same volume in both modes"""
+    rng = np.random.default_rng(1)
+    raw = rng.integers(-600, 400, size=(6, 16, 15)).astype(np.int16)
+    low, high = np.quantile(raw, (MIN_QUANTILE, MAX_QUANTILE))
+    assert low < 0 and low % 1 and high % 1
+
+    standard = load_jaw(raw, low_memory=False)
+    low_memory = load_jaw(raw, low_memory=True)
+
+    assert standard.max_value == low_memory.max_value
+    assert np.array_equal(standard.volume, low_memory.volume)
+    assert np.array_equal(standard.get_min_max_HU(), low_memory.get_min_max_HU())
+    # the clipped raw minimum is the quantile truncated toward zero, as the integer volume stores it
+    assert standard.volume.min() * standard.max_value == np.trunc(low)
+    # derived volumes are built on first request only
+    assert np.allclose(standard.HU_volume, low_memory.HU_volume)
+    assert np.allclose(standard.final_HU, low_memory.final_HU)
+    assert low_memory.HU_volume is low_memory.HU_volume and low_memory.final_HU is low_memory.final_HU
+
+
+if __name__ == "__main__":
+    test_low_memory_volume_negative_raw()
+    print("low memory volume: OK")
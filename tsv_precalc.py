@@ -11,7 +11,7 @@ import warnings
 if not sys.warnoptions:
     warnings.simplefilter("ignore")
 
-TOOL_DIRS = ['side_volume', 'annotated_dicom', 'masks']
+TOOL_DIRS = ['side_volume', 'annotated_dicom', 'masks', 'jaw_cache']
 TOOL_FILES = ['dump.json', 'history.json', 'gt_volume.npy', 'volume.npy']
 
 
@@ -56,8 +56,9 @@ def clean(root):
 
 
 def extract_gt(dicomdir):
-    ah = ArchHandler(dicomdir)
-    ah.__init__(dicomdir)
+    # HU volumes are not needed to compute the side volume, the memory budget mode fits more workers
+    ah = ArchHandler(dicomdir, keep_pixel_data=False, low_memory=True)
+    ah.__init__(dicomdir, keep_pixel_data=False, low_memory=True)
     ah.compute_initial_state(96, want_side_volume=False)
     ah.extract_data_from_gt(load_annotations=False)
     try:
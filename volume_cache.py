@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+CACHE_DIRNAME = 'jaw_cache'
+META_FILENAME = 'meta.json'
+
+
+class VolumeCache:
+
+    def __init__(self, dicomdir_path, paths, version):
+        """
+        persistent cache of the volumes derived from a DICOM series. arrays are stored as npy files
+        in a directory next to the DICOMDIR and memory-mapped back when the same series is opened again.
+
+        Args:
+            dicomdir_path (str): path of the DICOMDIR file
+            paths (list of str): paths of the files of the series
+            version: version of the pipeline that derives the arrays, changing it invalidates the cache
+        """
+        self.root = os.path.join(os.path.dirname(os.path.abspath(dicomdir_path)), CACHE_DIRNAME)
+        self.key = self.compute_key(dicomdir_path, paths, version)
+        self.dir = os.path.join(self.root, self.key)
+
+    @staticmethod
+    def compute_key(dicomdir_path, paths, version):
+        """
+        fast hash of a series: the content of the DICOMDIR plus name, size and modification time of each file
+
+        Args:
+            dicomdir_path (str): path of the DICOMDIR file
+            paths (list of str): paths of the files of the series
+            version: version of the pipeline that derives the arrays
+
+        Returns:
+            (str): hex digest of the series
+        """
+        digest = hashlib.sha1(str(version).encode())
+        with open(dicomdir_path, 'rb') as dicomdir:
+            digest.update(dicomdir.read())
+        for path in paths:
+            stat = os.stat(path)
+            digest.update("{}:{}:{}".format(os.path.basename(path), stat.st_size, stat.st_mtime_ns).encode())
+        return digest.hexdigest()
+
+    def exists(self):
+        """
+        Returns:
+            (bool): there is a complete cache entry for the series
+        """
+        return os.path.isfile(os.path.join(self.dir, META_FILENAME))
+
+    def load(self, mmap_mode='c'):
+        """
+        memory-map the cached arrays. with the default copy-on-write mode arrays can be freely
+        modified in memory, changes are never written back to the cache
+
+        Args:
+            mmap_mode (str): numpy memory-map mode
+
+        Returns:
+            (dict, dict): arrays and scalar values stored with them
+        """
+        with open(os.path.join(self.dir, META_FILENAME), "r") as infile:
+            meta = json.load(infile)
+        arrays = {
+            name: np.load(os.path.join(self.dir, "{}.npy".format(name)), mmap_mode=mmap_mode)
+            for name in meta['arrays']
+        }
+        return arrays, meta['values']
+
+    def save(self, arrays, values):
+        """
+        store a new cache entry for the series, replacing the stale ones.
+        the entry is written aside and moved in place only once complete.
+
+        Args:
+            arrays (dict): arrays to store, by name
+            values (dict): json serializable scalar values to store with them
+        """
+        tmp_dir = self.dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, "{}.npy".format(name)), array)
+        with open(os.path.join(tmp_dir, META_FILENAME), "w") as outfile:
+            json.dump({'arrays': list(arrays.keys()), 'values': values}, outfile)
+        self.clear()
+        os.replace(tmp_dir, self.dir)
+
+    def load_array(self, name, mmap_mode='c'):
+        """
+        memory-map a single array added to the entry with save_array
+
+        Args:
+            name (str): name of the array
+            mmap_mode (str): numpy memory-map mode
+
+        Returns:
+            (numpy array): the array, None if the entry does not have it
+        """
+        path = os.path.join(self.dir, "{}.npy".format(name))
+        return np.load(path, mmap_mode=mmap_mode) if os.path.isfile(path) else None
+
+    def save_array(self, name, array):
+        """
+        add an array derived later on to the existing entry of the series. the array is written aside
+        and moved in place only once complete.
+
+        Args:
+            name (str): name of the array
+            array (numpy array): array to store
+        """
+        if not self.exists():
+            return
+        path = os.path.join(self.dir, "{}.npy".format(name))
+        with open(path + '.tmp', 'wb') as outfile:
+            np.save(outfile, array)
+        os.replace(path + '.tmp', path)
+
+    def clear(self):
+        """remove every entry of the cache"""
+        if not os.path.isdir(self.root):
+            return
+        for entry in os.listdir(self.root):
+            path = os.path.join(self.root, entry)
+            if path != self.dir + '.tmp':
+                shutil.rmtree(path, ignore_errors=True)